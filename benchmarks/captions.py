@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+from datetime import date
+from dataclasses import replace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lostfilm_parser
+
+
+def legacy_markdownv2_converter(text):
+    symbols_for_replace = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+    for symbol in symbols_for_replace:
+        text = text.replace(symbol, '\\' + symbol)
+    return text
+
+
+def synthetic_schedule(size=500):
+    schedule = []
+    for number in range(1, size + 1):
+        release = date(2026, 10, number % 28 + 1)
+        url = f'https://www.lostfilmtv5.site/series/Show_{number}/season_1/episode_{number}/'
+        if number % 9 == 0:
+            schedule.append(lostfilm_parser.Movie(
+                name=f'Film #{number}: [Director\'s cut] (2026)!',
+                name_ru=f'Фильм №{number} — «режиссёрская версия»',
+                url=url,
+                date=release,
+            ))
+        else:
+            schedule.append(lostfilm_parser.Episode(
+                show_name=f'Show_{number % 40} (US) *{number}*',
+                show_name_ru=f'Шоу {number % 40}. Продолжение',
+                season_number=999 if number % 17 == 0 else number % 12 + 1,
+                number=number % 24 + 1,
+                name=f'Episode {number}: the_end-game. {{part}} |{number}|',
+                name_ru='' if number % 5 == 0 else f'Эпизод {number} + финал = ~конец~',
+                url=url,
+                date=release,
+            ))
+    schedule.sort(key=lambda episode: episode.date)
+    return schedule
+
+
+def render(schedule):
+    captions = [
+        lostfilm_parser.generate_schedule_caption('сегодня', schedule),
+        lostfilm_parser.generate_schedule_caption('на следующей неделе', schedule),
+    ]
+    for episode in schedule:
+        episode = replace(episode, description='Описание (серии) — #1! Конец.')
+        if episode.is_show:
+            captions.append(lostfilm_parser.generate_episode_caption(episode))
+        else:
+            captions.append(lostfilm_parser.generate_movie_caption(episode))
+    return captions
+
+
+def measure(schedule, repeat=20):
+    captions = render(schedule)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        render(schedule)
+    return captions, (time.perf_counter() - started) / repeat
+
+
+def main():
+    schedule = synthetic_schedule()
+    converter = lostfilm_parser.markdownv2_converter
+    lostfilm_parser.markdownv2_converter = legacy_markdownv2_converter
+    legacy_captions, legacy_time = measure(schedule)
+    lostfilm_parser.markdownv2_converter = converter
+    captions, elapsed = measure(schedule)
+    identical = captions == legacy_captions
+    print(f'{len(schedule)} entries, {len(captions)} captions, {sum(map(len, captions))} characters')
+    print(f'legacy escaping:  {legacy_time * 1000:.1f} ms per render')
+    print(f'current escaping: {elapsed * 1000:.1f} ms per render ({legacy_time / elapsed:.1f}x)')
+    print(f'output byte-identical: {identical}')
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
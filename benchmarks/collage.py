@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import numpy
+import tracemalloc
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lostfilm_parser import generate_schedule_collage, collage_grid
+
+
+class TileCache:
+
+    def __init__(self, tile_size):
+        tile_width, tile_height = tile_size
+        self.tile = numpy.random.default_rng(0).integers(0, 255, (tile_height, tile_width, 3), dtype='uint8')
+
+    def load_array(self, url, size):
+        return self.tile
+
+    def load(self, url):
+        return None
+
+
+def stacked_collage(cache, posters_url, tile_size=(715, 330), quality=95):
+    posters = [cache.load_array(url, tile_size) for url in posters_url]
+    blank_logo = cache.load_array('blank', tile_size)
+    columns, lines = collage_grid(len(posters))
+    for _ in range(columns * lines - len(posters)):
+        posters.append(blank_logo)
+    vertical = []
+    for line in range(lines):
+        vertical.append(numpy.hstack(posters[line * columns:(line + 1) * columns]))
+    numpy_collage = numpy.vstack(vertical)
+    is_success, buffer = cv2.imencode('.jpg', numpy_collage, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def canvas_collage(cache, posters_url, tile_size=(715, 330), quality=95):
+    return generate_schedule_collage('blank', posters_url, None, cache, tile_size, quality)
+
+
+def measure(build, cache, posters_url, repeat=3):
+    tracemalloc.start()
+    build(cache, posters_url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        build(cache, posters_url)
+    elapsed = (time.perf_counter() - started) / repeat
+    return elapsed, peak
+
+
+def main():
+    cache = TileCache((715, 330))
+    print(f'{"posters":>7} {"stack ms":>9} {"stack MiB":>9} {"canvas ms":>9} {"canvas MiB":>10}')
+    for posters_count in (1, 2, 5, 10, 20, 30, 40):
+        posters_url = [f'poster{number}' for number in range(posters_count)]
+        stack_time, stack_peak = measure(stacked_collage, cache, posters_url)
+        canvas_time, canvas_peak = measure(canvas_collage, cache, posters_url)
+        print(
+            f'{posters_count:>7} {stack_time * 1000:>9.1f} {stack_peak / 1024 ** 2:>9.1f}'
+            f' {canvas_time * 1000:>9.1f} {canvas_peak / 1024 ** 2:>10.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import glob
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lostfilm_parser import page_meta, page_meta_soup
+from fixtures import episode_page, movie_page, schedule_page
+
+BASE = 'https://www.lostfilmtv5.site/'
+
+
+def load_pages(fixtures_dir):
+    if fixtures_dir:
+        episodes = []
+        for path in sorted(glob.glob(os.path.join(fixtures_dir, '*.html'))):
+            with open(path, encoding='utf-8') as page:
+                episodes.append(page.read())
+        return [page for page in episodes if 'schedule-list' not in page], \
+            [page for page in episodes if 'schedule-list' in page]
+    episodes = [episode_page(BASE, number) for number in range(1, 21)] + [movie_page(BASE, 1)]
+    return episodes, [schedule_page(BASE, rows_per_section=15)]
+
+
+def measure(function, pages, repeat=5):
+    tracemalloc.start()
+    results = [function(page) for page in pages]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started = time.process_time()
+    for _ in range(repeat):
+        for page in pages:
+            function(page)
+    cpu = (time.process_time() - started) / repeat / len(pages)
+    return results, cpu, peak
+
+
+def schedule_soup(text):
+    from bs4 import BeautifulSoup
+    schedule = BeautifulSoup(text, features='html.parser')
+    return schedule.find('meta', property='og:image').get('content'), len(schedule.findAll('tr'))
+
+
+def schedule_strained(text):
+    from bs4 import BeautifulSoup, SoupStrainer
+    schedule = BeautifulSoup(text, features='html.parser', parse_only=SoupStrainer(['meta', 'tr']))
+    return schedule.find('meta', property='og:image').get('content'), len(schedule.findAll('tr'))
+
+
+def report(name, baseline, candidate):
+    baseline_results, baseline_cpu, baseline_peak = baseline
+    results, cpu, peak = candidate
+    identical = 'identical' if results == baseline_results else 'DIFFERENT'
+    print(
+        f'{name:<9} soup {baseline_cpu * 1000:7.2f} ms {baseline_peak / 1024:8.0f} KiB | '
+        f'fast {cpu * 1000:7.2f} ms {peak / 1024:8.0f} KiB | results {identical}'
+    )
+
+
+def main():
+    argument_parser = ArgumentParser(description='Compare page parsing engines on saved HTML.')
+    argument_parser.add_argument('--fixtures', help='directory with saved episode and schedule pages (*.html)')
+    arguments = argument_parser.parse_args()
+    episodes, schedules = load_pages(arguments.fixtures)
+    if episodes:
+        report('episode', measure(page_meta_soup, episodes), measure(page_meta, episodes))
+    if schedules:
+        report('schedule', measure(schedule_soup, schedules), measure(schedule_strained, schedules))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+HEAD_FILLER = ''.join(
+    f'<link rel="stylesheet" href="/css/style{number}.css"><script src="/js/app{number}.js"></script>\n'
+    for number in range(40)
+)
+BODY_FILLER = ''.join(
+    f'<div class="comment"><div class="author">user{number}</div><div class="text">{"Текст комментария. " * 12}</div></div>\n'
+    for number in range(300)
+)
+
+
+def episode_title(number):
+    return f'Шоу {number % 7} (Show {number % 7}). {number % 5 + 1} сезон {number} серия, Имя {number} (Name {number})'
+
+
+def episode_page(base, number):
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        f'<title>{episode_title(number)}: кадры, описание, актеры</title>\n'
+        f'{HEAD_FILLER}'
+        f'<meta property="og:image" content="{base}Images/{number % 7}/Posters/e_{number}.jpg">\n'
+        f'<meta property="og:description" content="Описание серии {number}.&nbsp;Продолжение следует!">\n'
+        f'</head><body><div class="content">{BODY_FILLER}</div></body></html>'
+    )
+
+
+def movie_page(base, number):
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        f'<title>Фильм {number} (Film {number}): кадры, описание, актеры</title>\n'
+        f'{HEAD_FILLER}'
+        f'<meta property="og:image" content="{base}Images/m{number}/Posters/e_1.jpg">\n'
+        f'<meta property="og:description" content="Описание фильма {number}.">\n'
+        f'</head><body><div class="content">{BODY_FILLER}</div></body></html>'
+    )
+
+
+def rss_feed(base, size, movies_every=10, newest=0):
+    published = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    items = []
+    for number in range(newest + size, newest, -1):
+        date = format_datetime(published + timedelta(minutes=10 * number))
+        if number % movies_every == 0:
+            title = f'Фильм {number} (Film {number}). (Фильм)'
+            link = f'{base}movies/Film_{number}/'
+        else:
+            title = f'Шоу {number % 7} (Show {number % 7}). Имя {number}. (S{number % 5 + 1:02}E{number:02})'
+            link = f'{base}series/Show_{number % 7}/season_{number % 5 + 1}/episode_{number}/'
+        items.append(
+            f'<item><title>{title}</title><link>{link}</link><guid>{link}</guid>'
+            f'<description>&lt;img src="{base}Images/{number % 7}/Posters/image.jpg" alt="" /&gt;</description>'
+            f'<pubDate>{date}</pubDate></item>'
+        )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>LostFilm.TV</title>'
+        + ''.join(items)
+        + '</channel></rss>'
+    )
+
+
+def schedule_row(base, number, date, movie=False):
+    host = base.split('://', 1)[-1]
+    if movie:
+        return (
+            f'<tr><td class="alpha"><img src="//{host}Images/m{number}/Posters/image.jpg"></td>'
+            f'<td class="beta" onclick="goTo(\'/movies/Film_{number}\',false);">'
+            f'<div class="serie-number-box">Фильм</div></td>'
+            f'<td class="gamma"><div>Фильм {number}</div><br/><div>Film {number}</div></td>'
+            f'<td class="delta">Дата выхода: {date}</td></tr>'
+        )
+    return (
+        f'<tr><td class="alpha"><img src="//{host}Images/{number}/Posters/image.jpg">'
+        f'<div class="ru">Шоу {number}</div><div class="en small-text">Show {number}</div></td>'
+        f'<td class="beta" onclick="goTo(\'/series/Show_{number}/season_1/episode_{number}/\',false);">'
+        f'<div class="count">1 сезон {number % 999 + 1} серия</div><div class="serie-number-box">{number}</div></td>'
+        f'<td class="gamma"><div>Имя {number}</div><br/><div>Name {number}</div></td>'
+        f'<td class="delta">Дата выхода: {date}</td></tr>'
+    )
+
+
+def schedule_page(base, rows_per_section=10):
+    sections = (
+        ('сегодня', '16.10.2026'),
+        ('завтра', '17.10.2026'),
+        ('на этой неделе', '18.10.2026'),
+        ('на следующей неделе', '23.10.2026'),
+    )
+    table = []
+    number = 0
+    for section, date in sections:
+        table.append(f'<tr><th colspan="6">{section}</th></tr>')
+        for _ in range(rows_per_section):
+            number += 1
+            table.append(schedule_row(base, number, date, movie=number % 9 == 0))
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Расписание</title>\n'
+        f'{HEAD_FILLER}'
+        f'<meta property="og:image" content="{base}Static/logo.jpg">\n'
+        f'</head><body>{BODY_FILLER[:20000]}<table class="schedule-list">{"".join(table)}</table>'
+        f'{BODY_FILLER[:20000]}</body></html>'
+    )
+
+
+def poster_jpeg(seed, size=(800, 450)):
+    import cv2
+    import numpy
+    width, height = size
+    random = numpy.random.default_rng(seed)
+    pic = random.integers(0, 255, (height // 10, width // 10, 3), dtype='uint8')
+    pic = cv2.resize(pic, size, interpolation=cv2.INTER_LINEAR)
+    is_success, buffer = cv2.imencode('.jpg', pic)
+    return buffer.tobytes()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from types import SimpleNamespace
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lostfilm_parser import Conf, Parser, generate_schedule_collage
+from fixtures import schedule_page
+from replay import ReplaySite, FakeBotApi, write_settings
+
+
+def replay_settings(site, api, arguments):
+    home = tempfile.mkdtemp(prefix='lostfilm-replay-')
+    write_settings(home, site, api, {
+        'workers': arguments.workers,
+        'send_rate': arguments.send_rate,
+        'send_burst': arguments.send_burst,
+    })
+    os.environ['HOME'] = home
+    return home, Conf()
+
+
+def full_run(site, api, arguments):
+    home, settings = replay_settings(site, api, arguments)
+    try:
+        started = time.perf_counter()
+        parser = Parser(settings)
+        parser.check_old_episodes()
+        parser.check_new_entries()
+        parser.send_new_episodes()
+        parser.scheduler()
+        elapsed = time.perf_counter() - started
+        parser.db.close()
+    finally:
+        shutil.rmtree(home)
+    return elapsed
+
+
+def new_entries_run(site, api, arguments, size):
+    home, settings = replay_settings(site, api, arguments)
+    try:
+        parser = Parser(settings)
+        started = time.perf_counter()
+        parser.check_new_entries()
+        new_entries = time.perf_counter() - started
+        page = SimpleNamespace(text=schedule_page(site.source, rows_per_section=max(1, size // 4)))
+        started = time.perf_counter()
+        for _ in range(arguments.repeat):
+            parser.schedule_parse(page)
+        parse = (time.perf_counter() - started) / arguments.repeat
+        posters = [f'{site.source}Images/{number}/Posters/poster.jpg' for number in range(min(size, 40))]
+        started = time.perf_counter()
+        for _ in range(arguments.repeat):
+            generate_schedule_collage(
+                f'{site.source}Static/logo.jpg',
+                posters,
+                parser.http,
+                tile_size=settings.collage_tile,
+                quality=settings.collage_quality,
+                workers=settings.workers,
+            )
+        collage = (time.perf_counter() - started) / arguments.repeat
+        parser.db.close()
+    finally:
+        shutil.rmtree(home)
+    return new_entries, parse, collage
+
+
+def main():
+    argument_parser = ArgumentParser(description='Time a full run and its stages against the replay stand-ins.')
+    argument_parser.add_argument('--sizes', default='10,30,100,300,1000', help='comma-separated feed sizes')
+    argument_parser.add_argument('--recordings', metavar='DIR', help='replay recordings instead of generated fixtures')
+    argument_parser.add_argument('--latency', type=float, default=0.0, help='Bot API latency, seconds')
+    argument_parser.add_argument('--site-latency', type=float, default=0.0, help='site latency, seconds')
+    argument_parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth Bot API call with 429')
+    argument_parser.add_argument('--send-rate', default='100000', help='[System] send_rate for the runs')
+    argument_parser.add_argument('--send-burst', default='100', help='[System] send_burst for the runs')
+    argument_parser.add_argument('--workers', default='8', help='[System] workers for the runs')
+    argument_parser.add_argument('--repeat', type=int, default=3, help='repeats for schedule_parse and collage')
+    arguments = argument_parser.parse_args()
+    home = os.environ.get('HOME')
+    print(
+        f'{"size":>5} {"run s":>7} {"new s":>7} {"parse ms":>9} {"collage ms":>10}'
+        f' {"hits":>6} {"MiB":>6} {"calls":>6} {"429":>4}'
+    )
+    try:
+        for size in (int(size) for size in arguments.sizes.split(',')):
+            site = ReplaySite(arguments.recordings, size=size, latency=arguments.site_latency)
+            api = FakeBotApi(latency=arguments.latency, throttle_every=arguments.throttle_every)
+            with site, api:
+                run = full_run(site, api, arguments)
+                hits, sent, calls, throttled = len(site.hits), site.bytes_sent, len(api.calls), api.throttled
+                new_entries, parse, collage = new_entries_run(site, api, arguments, size)
+            print(
+                f'{size:>5} {run:>7.2f} {new_entries:>7.2f} {parse * 1000:>9.1f} {collage * 1000:>10.1f}'
+                f' {hits:>6} {sent / 1024 ** 2:>6.1f} {calls:>6} {throttled:>4}'
+            )
+    finally:
+        if home is not None:
+            os.environ['HOME'] = home
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+from zlib import crc32
+from functools import lru_cache
+from urllib.parse import urljoin, urlsplit, parse_qsl
+from argparse import ArgumentParser
+from email.policy import default as email_policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixtures import episode_page, movie_page, rss_feed, schedule_page, poster_jpeg
+
+GENERATED_HOST = 'www.lostfilmtv5.site'
+PATTERN_GENERATED_EPISODE = re.compile(r'/episode_(\d+)/?$')
+PATTERN_GENERATED_MOVIE = re.compile(r'/movies/Film_(\d+)/?$')
+PATTERN_BOT_METHOD = re.compile(r'^/bot([^/]+)/(\w+)$')
+CONTENT_TYPES = {
+    '.xml': 'application/rss+xml; charset=utf-8',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+
+class StandIn:
+
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.base = f'http://127.0.0.1:{self.server.server_port}/'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ReplaySite(StandIn):
+
+    def __init__(self, recordings=None, size=100, rows_per_section=10, latency=0.0):
+        self.recordings = recordings
+        self.size = size
+        self.rows_per_section = rows_per_section
+        self.latency = latency
+        self.hits = []
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        super().__init__(ReplaySiteHandler)
+        if recordings:
+            with open(os.path.join(recordings, 'source')) as source_file:
+                self.source_host = urlsplit(source_file.read().strip()).netloc
+            self.hosts = sorted(
+                name for name in os.listdir(recordings)
+                if os.path.isdir(os.path.join(recordings, name))
+            )
+        else:
+            self.source_host = GENERATED_HOST
+            self.hosts = [GENERATED_HOST]
+
+    @property
+    def source(self):
+        return f'{self.base}{self.source_host}/'
+
+    def rewrite(self, text):
+        for host in self.hosts:
+            local = f'{self.base}{host}/'
+            text = text.replace(f'https://{host}/', local).replace(f'http://{host}/', local)
+            text = text.replace(f'//{host}/', f'//{local.split("://", 1)[1]}')
+        return text
+
+    def recorded(self, host, path):
+        if path.endswith('/'):
+            path += 'index.html'
+        file_path = os.path.join(self.recordings, host, path.lstrip('/'))
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'rb') as recorded_file:
+            body = recorded_file.read()
+        content_type = CONTENT_TYPES.get(os.path.splitext(file_path)[1], 'text/html; charset=utf-8')
+        if not content_type.startswith('image/'):
+            body = self.rewrite(body.decode('utf-8')).encode('utf-8')
+        return body, content_type
+
+    def generated(self, host, path):
+        source = self.source
+        if path == '/rss.xml':
+            return rss_feed(source, self.size).encode('utf-8'), CONTENT_TYPES['.xml']
+        if path.startswith('/schedule'):
+            return schedule_page(source, self.rows_per_section).encode('utf-8'), 'text/html; charset=utf-8'
+        if path.endswith('.jpg'):
+            return generated_poster(crc32(path.encode('utf-8')) % 64), CONTENT_TYPES['.jpg']
+        episode = PATTERN_GENERATED_EPISODE.search(path)
+        if episode:
+            return episode_page(source, int(episode.group(1))).encode('utf-8'), 'text/html; charset=utf-8'
+        movie = PATTERN_GENERATED_MOVIE.search(path)
+        if movie:
+            return movie_page(source, int(movie.group(1))).encode('utf-8'), 'text/html; charset=utf-8'
+        return None
+
+    def serve(self, path):
+        host, _, path = path.lstrip('/').partition('/')
+        path = '/' + path.split('?', 1)[0]
+        if self.recordings:
+            return self.recorded(host, path)
+        return self.generated(host, path)
+
+
+@lru_cache(maxsize=None)
+def generated_poster(seed):
+    return poster_jpeg(seed)
+
+
+class ReplaySiteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        site = self.server.stand_in
+        if site.latency:
+            time.sleep(site.latency)
+        found = site.serve(self.path)
+        if found is None:
+            self.send_error(404)
+            return
+        body, content_type = found
+        with site.lock:
+            site.hits.append(self.path)
+            site.bytes_sent += len(body)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBotApi(StandIn):
+
+    def __init__(self, latency=0.0, throttle_every=0, retry_after=1):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.calls = []
+        self.throttled = 0
+        self.message_id = 0
+        self.lock = threading.Lock()
+        super().__init__(FakeBotApiHandler)
+
+    @property
+    def api_url(self):
+        return self.base
+
+    def count(self, method):
+        return sum(1 for name, _ in self.calls if name == method)
+
+    def answer(self, method, fields):
+        with self.lock:
+            self.calls.append((method, fields))
+            if self.throttle_every and len(self.calls) % self.throttle_every == 0:
+                self.throttled += 1
+                return 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }
+            self.message_id += 1
+            message_id = self.message_id
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+        elif method in ('sendPhoto', 'editMessageMedia', 'editMessageCaption'):
+            result = self.message(fields, message_id)
+            result['photo'] = [self.photo(fields, message_id)]
+            result['caption'] = fields.get('caption', '')
+        elif method == 'sendMediaGroup':
+            media = json.loads(fields.get('media', '[]'))
+            result = []
+            for number, _ in enumerate(media):
+                message = self.message(fields, message_id * 100 + number)
+                message['photo'] = [self.photo({}, message_id * 100 + number)]
+                result.append(message)
+        elif method == 'sendMessage':
+            result = self.message(fields, message_id)
+            result['text'] = fields.get('text', '')
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    @staticmethod
+    def message(fields, message_id):
+        chat_id = fields.get('chat_id', '0')
+        return {
+            'message_id': int(fields.get('message_id', message_id)),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id) if chat_id.lstrip('-').isdigit() else 0, 'type': 'channel'},
+        }
+
+    @staticmethod
+    def photo(fields, message_id):
+        photo = fields.get('photo', '')
+        if not photo.startswith('<') and photo:
+            file_id = photo
+        else:
+            file_id = f'replay-{message_id}'
+        return {'file_id': file_id, 'file_unique_id': file_id, 'width': 715, 'height': 330}
+
+
+def request_fields(headers, body):
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('multipart/'):
+        message = BytesParser(policy=email_policy).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body)
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                fields[name] = f'<{len(payload)} bytes>'
+            else:
+                fields[name] = payload.decode('utf-8')
+        return fields
+    return dict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        api = self.server.stand_in
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if api.latency:
+            time.sleep(api.latency)
+        path, _, query = self.path.partition('?')
+        bot_method = PATTERN_BOT_METHOD.match(path)
+        if not bot_method:
+            self.send_error(404)
+            return
+        fields = dict(parse_qsl(query, keep_blank_values=True))
+        fields.update(request_fields(self.headers, body))
+        status, answer = api.answer(bot_method.group(2), fields)
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def write_settings(home, site, api, extra=None):
+    work_dir = os.path.join(home, '.config', 'LostFilmParser')
+    os.makedirs(work_dir, exist_ok=True)
+    system = {
+        'source': site.source,
+        'db': 'sqlite:///entries.db',
+        'lifetime': '90',
+        'telegram_api': api.api_url,
+    }
+    system.update(extra or {})
+    with open(os.path.join(work_dir, 'settings.conf'), 'w') as config_file:
+        config_file.write('[Settings]\nbotid = 123456789:replay\nchatid = -100123\n\n[System]\n')
+        for setting, value in system.items():
+            config_file.write(f'{setting} = {value}\n')
+    return work_dir
+
+
+def record(source, directory, limit=50):
+    import requests
+    import feedparser
+    from lostfilm_parser import page_meta
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'source'), 'w') as source_file:
+        source_file.write(source)
+
+    def save(url):
+        parts = urlsplit(url if '://' in url else 'https:' + url)
+        path = parts.path + 'index.html' if parts.path.endswith('/') else parts.path
+        file_path = os.path.join(directory, parts.netloc, path.lstrip('/'))
+        response = session.get(parts.geturl(), timeout=30)
+        response.raise_for_status()
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as recorded_file:
+            recorded_file.write(response.content)
+        return response
+
+    feed = feedparser.parse(save(source.rstrip('/') + '/rss.xml').content)
+    for entry in feed['entries'][:limit]:
+        page = save(entry['link'].replace('/mr/', '/'))
+        page.encoding = 'utf-8'
+        _, poster, _ = page_meta(page.text)
+        if poster:
+            save(urljoin(page.url, poster))
+    schedule = save(source.rstrip('/') + '/schedule/type_0')
+    schedule.encoding = 'utf-8'
+    for image in re.findall(r'(?:og:image" content="|<img src=")([^"]+\.jpg)', schedule.text)[:limit]:
+        save(urljoin(schedule.url, image))
+
+
+def main():
+    argument_parser = ArgumentParser(description='Record the site or serve recordings and a fake Bot API locally.')
+    argument_parser.add_argument('--record', metavar='DIR', help='save the live feed, pages and posters to DIR')
+    argument_parser.add_argument('--source', default='https://www.lostfilmtv5.site/', help='site to record')
+    argument_parser.add_argument('--limit', type=int, default=50, help='feed entries and posters to record')
+    argument_parser.add_argument('--recordings', metavar='DIR', help='serve DIR instead of generated fixtures')
+    argument_parser.add_argument('--size', type=int, default=100, help='entries in the generated feed')
+    argument_parser.add_argument('--latency', type=float, default=0.0, help='Bot API latency, seconds')
+    argument_parser.add_argument('--throttle-every', type=int, default=0, help='answer every Nth call with 429')
+    arguments = argument_parser.parse_args()
+    if arguments.record:
+        record(arguments.source, arguments.record, arguments.limit)
+        return
+    site = ReplaySite(arguments.recordings, size=arguments.size)
+    api = FakeBotApi(latency=arguments.latency, throttle_every=arguments.throttle_every)
+    with site, api:
+        print(f'source = {site.source}')
+        print(f'telegram_api = {api.api_url}')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(f'{len(site.hits)} site hits, {len(api.calls)} Bot API calls, {api.throttled} throttled')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('cv2', 'numpy', 'bs4', 'telebot', 'feedparser')
+PROBE = f'''
+import sys, json, time
+sys.path.insert(0, {ROOT!r})
+started = time.perf_counter()
+import lostfilm_parser
+elapsed = time.perf_counter() - started
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+'''
+
+
+def measure(repeat=10):
+    timings = []
+    loaded = set()
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True)
+        probe = json.loads(result.stdout)
+        timings.append(probe['elapsed'])
+        loaded.update(probe['loaded'])
+    return timings, sorted(loaded)
+
+
+def main():
+    timings, loaded = measure()
+    print(f'import lostfilm_parser: median {statistics.median(timings) * 1000:.1f} ms, '
+          f'min {min(timings) * 1000:.1f} ms over {len(timings)} runs')
+    if loaded:
+        print(f'heavy modules loaded at import time: {", ".join(loaded)}')
+        sys.exit(1)
+    print('no heavy modules loaded at import time')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,25 +3,54 @@
 
 import os
 import re
-import cv2
-import numpy
+import json
+import math
+import calendar
+import time
+import queue
+import random
+import signal
+import threading
+import traceback
 import peewee
 import requests
+from io import BytesIO
 from hashlib import sha1
-from telebot import TeleBot
-from bs4 import BeautifulSoup
+from functools import partial, lru_cache
+from contextlib import contextmanager
+from itertools import repeat
 from urllib.parse import urljoin
-from urllib.request import urlopen
-from playhouse.db_url import connect
+from playhouse.db_url import connect, schemes as db_schemes
+from playhouse.pool import PooledDatabase
+from argparse import ArgumentParser
+from html.parser import HTMLParser
 from configparser import ConfigParser
-from datetime import datetime, timedelta
-from telebot.types import InputMediaPhoto
-from feedparser import parse as feed_parse
-from playhouse.shortcuts import model_to_dict
-from telebot.apihelper import ApiTelegramException
+from email.utils import parsedate_to_datetime
+from xml.etree.ElementTree import iterparse, ParseError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from datetime import date, datetime, timedelta, timezone
+from dataclasses import dataclass, field, fields, replace
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from playhouse.migrate import SchemaMigrator, migrate
 
 
 db_proxy = peewee.DatabaseProxy()
+COLLAGE_ASPECT = 16 / 9
+TELEGRAM_PHOTO_SIDES = 10000
+MARKDOWNV2_ESCAPES = tuple((symbol, '\\' + symbol) for symbol in '_*[]()~`>#+-=|{}.!')
+PATTERN_EPISODE_INFO = re.compile(r'^(.*) \((.*)\). (\d+) сезон (\d+) серия, (.*?[.]*?) \((.*)\): кадры.*$')
+PATTERN_MOVIE_INFO = re.compile(r'^(.*) \((.*)\): кадры.*$')
+PATTERN_ENTRY_EPISODE = re.compile(r'^(.*) \((.*)\). (.*). \(S(\d+)E(\d+)\)')
+PATTERN_ENTRY_SPECIAL = re.compile(r'^(.*) \((.*)\). (.*). \((.*) (\d+)\)')
+PATTERN_ENTRY_MOVIE = re.compile(r'^(.*) \((.*)\). \(Фильм\)$')
+PATTERN_SCHEDULE_SEASON_EPISODE = re.compile(r'^(\d{1,3})[ ]сезон[ ](\d{1,3})[ ]серия$')
+PATTERN_SCHEDULE_SPECIAL = re.compile(r'^Спецэпизод[ ](\d{1,3})$')
+PATTERN_SCHEDULE_SERIES_URL = re.compile(r"^goTo\('(\/series\/.*)',false\);$")
+PATTERN_SCHEDULE_MOVIE_URL = re.compile(r"^goTo\('(\/movies\/.*)',false\);$")
+PATTERN_SCHEDULE_DATE = re.compile(r'\d{2}.\d{2}.\d{4}')
+PATTERN_FEED_ITEM = re.compile(rb'<item>.*?</item>', re.S)
 
 
 def poster_from_data(data):
@@ -32,50 +61,53 @@ def poster_from_data(data):
     return poster
 
 
-def episode_info_from_data(data):
-    episode_info = {}
-    movie_info = {}
-    pattern_episode = r'^(.*) \((.*)\). (\d+) сезон (\d+) серия, (.*?[.]*?) \((.*)\): кадры.*$'
-    pattern_movie = r'^(.*) \((.*)\): кадры.*$'
-    re_episode_info = re.match(pattern_episode, data)
+def episode_info_from_data(data, **details):
+    re_episode_info = PATTERN_EPISODE_INFO.match(data)
     if re_episode_info:
-        episode_info['show_name_ru'] = re_episode_info.group(1)
-        episode_info['show_name'] = re_episode_info.group(2)
-        episode_info['season_number'] = int(re_episode_info.group(3))
-        episode_info['number'] = int(re_episode_info.group(4))
-        episode_info['name_ru'] = re_episode_info.group(5)
-        episode_info['name'] = re_episode_info.group(6)
-        return episode_info
+        return Episode(
+            show_name_ru=re_episode_info.group(1),
+            show_name=re_episode_info.group(2),
+            season_number=int(re_episode_info.group(3)),
+            number=int(re_episode_info.group(4)),
+            name_ru=re_episode_info.group(5),
+            name=re_episode_info.group(6),
+            **details,
+        )
     else:
-        re_movie_info = re.match(pattern_movie, data)
-        movie_info['name_ru'] = re_movie_info.group(1)
-        movie_info['name'] = re_movie_info.group(2)
-        return movie_info
+        re_movie_info = PATTERN_MOVIE_INFO.match(data)
+        return Movie(name_ru=re_movie_info.group(1), name=re_movie_info.group(2), **details)
 
 
 def markdownv2_converter(text):
-    symbols_for_replace = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    for symbol in symbols_for_replace:
-        text = text.replace(symbol, '\\' + symbol)
+    for symbol, escaped_symbol in MARKDOWNV2_ESCAPES:
+        if symbol in text:
+            text = text.replace(symbol, escaped_symbol)
     return text
 
 
+@lru_cache(maxsize=4096)
+def entry_caption(entry):
+    if entry.is_show:
+        return generate_episode_caption(entry)
+    return generate_movie_caption(entry)
+
+
 def generate_episode_caption(entry):
-    if entry["show_name"] == entry["show_name_ru"]:
-        show_name = markdownv2_converter(f'{entry["show_name"]}')
+    if entry.show_name == entry.show_name_ru:
+        show_name = markdownv2_converter(f'{entry.show_name}')
     else:
-        show_name = markdownv2_converter(f'{entry["show_name_ru"]} ({entry["show_name"]})')
-    if entry["season_number"] == 999:
-        episode_numbers = markdownv2_converter(f'Спецэпизод {entry["number"]}')
+        show_name = markdownv2_converter(f'{entry.show_name_ru} ({entry.show_name})')
+    if entry.season_number == 999:
+        episode_numbers = markdownv2_converter(f'Спецэпизод {entry.number}')
     else:
-        episode_numbers = markdownv2_converter(f'{entry["season_number"]} сезон, {entry["number"]} эпизод')
-    if not entry['name_ru'] or entry['name_ru'] == entry['name']:
-        episode_name = markdownv2_converter(f'{entry["name"]}')
+        episode_numbers = markdownv2_converter(f'{entry.season_number} сезон, {entry.number} эпизод')
+    if not entry.name_ru or entry.name_ru == entry.name:
+        episode_name = markdownv2_converter(f'{entry.name}')
     else:
-        episode_name = markdownv2_converter(f'{entry["name_ru"]} ({entry["name"]})')
-    episode_link = entry['url']
-    if entry['description']:
-        description = 'Описание:\n||' + markdownv2_converter(entry['description']) + '||'
+        episode_name = markdownv2_converter(f'{entry.name_ru} ({entry.name})')
+    episode_link = entry.url
+    if entry.description:
+        description = 'Описание:\n||' + markdownv2_converter(entry.description) + '||'
     else:
         description = ''
     caption = f'*{show_name}*\n{episode_numbers}:\n[{episode_name}]({episode_link})\n\n{description}'
@@ -83,17 +115,17 @@ def generate_episode_caption(entry):
 
 
 def generate_movie_caption(entry):
-    if entry['name'] == entry['name_ru']:
-        name = f'{entry["name"]}'
+    if entry.name == entry.name_ru:
+        name = f'{entry.name}'
     else:
-        name = f'{entry["name_ru"]} ({entry["name"]})'
-    movie_link = entry['url']
+        name = f'{entry.name_ru} ({entry.name})'
+    movie_link = entry.url
     description = ''
-    if entry['description']:
+    if entry.description:
         description_crop = ''
         crop = 1024 - len(name) - 15
-        if crop != len(entry['description']):
-            description_crop = entry['description']
+        if crop != len(entry.description):
+            description_crop = entry.description
             description_crop = description_crop[:crop - 3] + '(...)'
         description = 'Описание:\n||' + markdownv2_converter(description_crop) + '||'
     caption = f'*[{markdownv2_converter(name)}]({movie_link})*\n\n{description}'
@@ -108,79 +140,163 @@ def generate_schedule_caption(section, schedule):
             markdownv2_converter(f'Релизы, запланированные ')
             + ('на ' * (not float_date))
             + f'*{section}*'
-            + (markdownv2_converter(f' [{schedule[0]["date"]}]') * (not float_date))
+            + (markdownv2_converter(f' [{schedule[0].date:%d.%m.%Y}]') * (not float_date))
             + markdownv2_converter('.')
     )
     for number, episode in enumerate(schedule, 1):
         number = markdownv2_converter(f'{number}.')
-        try:
-            is_show = bool(episode["show_name"])
-        except KeyError:
-            is_show = False
-        if is_show:
-            if episode["show_name"] == episode["show_name_ru"]:
-                show_name = markdownv2_converter(f'{episode["show_name"]}:')
+        if episode.is_show:
+            if episode.show_name == episode.show_name_ru:
+                show_name = markdownv2_converter(f'{episode.show_name}:')
             else:
-                show_name = markdownv2_converter(f'{episode["show_name_ru"]} ({episode["show_name"]}):')
-            if episode['season_number'] == 999:
-                episode_numbers = markdownv2_converter(f'SpE{episode["number"]:02}')
+                show_name = markdownv2_converter(f'{episode.show_name_ru} ({episode.show_name}):')
+            if episode.season_number == 999:
+                episode_numbers = markdownv2_converter(f'SpE{episode.number:02}')
             else:
-                episode_numbers = markdownv2_converter(f'S{episode["season_number"]:02}E{episode["number"]:02}')
-            if not episode['name_ru'] or episode['name_ru'] == episode['name']:
-                episode_name = markdownv2_converter(f'{episode["name"]}')
+                episode_numbers = markdownv2_converter(f'S{episode.season_number:02}E{episode.number:02}')
+            if not episode.name_ru or episode.name_ru == episode.name:
+                episode_name = markdownv2_converter(f'{episode.name}')
             else:
-                episode_name = markdownv2_converter(f'{episode["name_ru"]} ({episode["name"]})')
-            episode_link = episode['url']
-            if date == episode['date']:
+                episode_name = markdownv2_converter(f'{episode.name_ru} ({episode.name})')
+            episode_link = episode.url
+            if date == episode.date:
                 pass
             else:
-                date = episode['date']
-                episodes += ('*' + markdownv2_converter(f'[{date}]:') + '*\n') * float_date
+                date = episode.date
+                episodes += ('*' + markdownv2_converter(f'[{date:%d.%m.%Y}]:') + '*\n') * float_date
             episodes += f'*{number}* {show_name} {episode_numbers} — [{episode_name}]({episode_link})\n'
         else:
-            if not episode['name_ru'] or episode['name_ru'] == episode['name']:
-                episode_name = markdownv2_converter(f'{episode["name"]}')
+            if not episode.name_ru or episode.name_ru == episode.name:
+                episode_name = markdownv2_converter(f'{episode.name}')
             else:
-                episode_name = markdownv2_converter(f'{episode["name_ru"]} ({episode["name"]})')
-            episode_link = episode['url']
-            if date == episode['date']:
+                episode_name = markdownv2_converter(f'{episode.name_ru} ({episode.name})')
+            episode_link = episode.url
+            if date == episode.date:
                 pass
             else:
-                date = episode['date']
-                episodes += ('*' + markdownv2_converter(f'[{date}]:') + '*\n') * float_date
+                date = episode.date
+                episodes += ('*' + markdownv2_converter(f'[{date:%d.%m.%Y}]:') + '*\n') * float_date
             episodes += f'*{number}* [{episode_name}]({episode_link})\n'
     message_text = f'{title}\n\n{episodes}'
     return message_text
 
 
-def generate_schedule_collage(blank_logo_url, posters_url):
-    posters = []
-    blank_logo = convert_url2pic(blank_logo_url)
-    for url in posters_url:
-        poster = convert_url2pic(url)
-        posters.append(poster)
-    posters_count = len(posters)
-    columns = round(posters_count ** .5)
-    lines = round_up(posters_count / columns)
-    blanks = columns * lines - posters_count
-    for _ in range(blanks):
-        posters.append(blank_logo)
-    horizontal = []
-    vertical = []
-    poster = 0
-    for line in range(lines):
-        for column in range(columns):
-            horizontal.append(posters[poster])
-            poster += 1
-        stack_horizontal = numpy.hstack(horizontal)
-        vertical.append(stack_horizontal)
-        horizontal = []
-    numpy_collage = numpy.vstack(vertical)
-    is_success, buffer = cv2.imencode(".jpg", numpy_collage)
-    collage = buffer.tobytes()
+def generate_schedule_collage(
+        blank_logo_url,
+        posters_url,
+        http,
+        cache=None,
+        tile_size=(715, 330),
+        quality=95,
+        workers=8,
+        timeout=None,
+        missed=None,
+        max_pixels=None,
+        max_bytes=None,
+        min_quality=60,
+):
+    import numpy
+    posters_count = len(posters_url)
+    columns, lines, tile_size = collage_layout(posters_count, tile_size, max_pixels)
+    canvas = collage_canvas(columns, lines, tile_size)
+    blank_positions = list(range(posters_count, columns * lines))
+    deadline = timeout and timeout * round_up((posters_count + 1) / workers)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        blank_logo_future = executor.submit(try_convert_url2pic, blank_logo_url, http, cache, tile_size, timeout)
+        futures = {
+            executor.submit(try_convert_url2pic, url, http, cache, tile_size, timeout): position
+            for position, url in enumerate(posters_url)
+        }
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                poster = future.result()
+                if poster is not None:
+                    place_tile(canvas, futures[future], columns, poster)
+                    del futures[future]
+        except FuturesTimeout:
+            metrics.count('errors', len(futures), stage='posters')
+        for position in sorted(futures.values()):
+            blank_positions.append(position)
+            if missed is not None:
+                missed.append(posters_url[position])
+        blank_logo = blank_logo_future.result() if blank_logo_future.done() else None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if blank_logo is None:
+        tile_width, tile_height = tile_size
+        blank_logo = numpy.zeros((tile_height, tile_width, 3), dtype='uint8')
+    for position in blank_positions:
+        place_tile(canvas, position, columns, blank_logo)
+    with metrics.stage('collage_encode'):
+        collage = encode_collage(canvas, quality, max_bytes, min_quality)
     return collage
 
 
+def encode_collage(canvas, quality=95, max_bytes=None, min_quality=60):
+    import cv2
+    while True:
+        is_success, buffer = cv2.imencode('.jpg', canvas, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not max_bytes or len(buffer) <= max_bytes:
+            return buffer.tobytes()
+        if quality > min_quality:
+            quality = max(quality - 10, min_quality)
+            continue
+        height, width = canvas.shape[:2]
+        scale = max((max_bytes / len(buffer)) ** .5, .5) * .95
+        if width * scale < 1 or height * scale < 1:
+            return buffer.tobytes()
+        canvas = cv2.resize(canvas, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def collage_grid(posters_count, tile_size=(715, 330)):
+    tile_width, tile_height = tile_size
+    best_score = None
+    columns, lines = 1, posters_count
+    for grid_columns in range(1, posters_count + 1):
+        grid_lines = round_up(posters_count / grid_columns)
+        aspect = grid_columns * tile_width / (grid_lines * tile_height)
+        blanks = grid_columns * grid_lines - posters_count
+        score = blanks / posters_count + abs(math.log(aspect / COLLAGE_ASPECT))
+        if best_score is None or score < best_score:
+            best_score = score
+            columns, lines = grid_columns, grid_lines
+    return columns, lines
+
+
+def collage_layout(posters_count, tile_size=(715, 330), max_pixels=None):
+    columns, lines = collage_grid(posters_count, tile_size)
+    tile_width, tile_height = tile_size
+    scale = min(1, TELEGRAM_PHOTO_SIDES / (columns * tile_width + lines * tile_height))
+    if max_pixels:
+        scale = min(scale, (max_pixels / (columns * lines * tile_width * tile_height)) ** .5)
+    tile_size = (max(int(tile_width * scale), 1), max(int(tile_height * scale), 1))
+    return columns, lines, tile_size
+
+
+def collage_pages(posters_count, page_size=20, max_pages=10):
+    if not page_size or posters_count <= page_size:
+        return [range(posters_count)]
+    pages = min(round_up(posters_count / page_size), max_pages)
+    bounds = [round(posters_count * page / pages) for page in range(pages + 1)]
+    return [range(start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def collage_canvas(columns, lines, tile_size):
+    import numpy
+    tile_width, tile_height = tile_size
+    canvas = numpy.empty((lines * tile_height, columns * tile_width, 3), dtype='uint8')
+    return canvas
+
+
+def place_tile(canvas, position, columns, pic):
+    tile_height, tile_width = pic.shape[:2]
+    line, column = divmod(position, columns)
+    top = line * tile_height
+    left = column * tile_width
+    canvas[top:top + tile_height, left:left + tile_width] = pic
+
+
 def round_up(num):
     num = num * (-1)
     num = num // 1
@@ -188,6 +304,49 @@ def round_up(num):
     return int(num)
 
 
+def stream_feed(content):
+    for event, element in iterparse(BytesIO(content), events=('end',)):
+        if element.tag.rsplit('}', 1)[-1] != 'item':
+            continue
+        item = {child.tag.rsplit('}', 1)[-1]: (child.text or '').strip() for child in element}
+        element.clear()
+        published = parsedate_to_datetime(item['pubDate'])
+        if published.tzinfo is None:
+            published = published.replace(tzinfo=timezone.utc)
+        yield {
+            'id': item.get('guid') or item.get('link', ''),
+            'title': item.get('title', ''),
+            'link': item.get('link', ''),
+            'summary': item.get('description', ''),
+            'published_parsed': published.astimezone(timezone.utc).utctimetuple(),
+        }
+
+
+def entries_above_mark(entries, mark=None):
+    above = []
+    head = None
+    for entry in entries:
+        published = entry.get('published_parsed')
+        published = calendar.timegm(published) if published else 0
+        if head is None:
+            head = {'guid': entry.get('id') or entry['link'], 'published': published}
+        if mark and ((entry.get('id') or entry['link']) == mark['guid'] or published < mark['published']):
+            break
+        above.append(entry)
+    return above, head
+
+
+def feed_fingerprint(content):
+    items = PATTERN_FEED_ITEM.findall(content)
+    hash_data = sha1(b''.join(items) or content)
+    return hash_data.hexdigest()
+
+
+def posters_fingerprint(blank_logo_url, posters_url, *layout):
+    data = '\n'.join([blank_logo_url, repr(layout), *posters_url])
+    return content_key(data)
+
+
 def fingerprint(data):
     data = data.lower()
     hash_data = sha1(data.encode('utf8'))
@@ -195,45 +354,221 @@ def fingerprint(data):
     return hexdigest_hash_data
 
 
-def convert_url2pic(url, size=(715, 330)):
-    open_url = urlopen(url)
-    pic = numpy.asarray(bytearray(open_url.read()), dtype='uint8')
+def try_convert_url2pic(url, http, cache=None, size=(715, 330), timeout=None):
+    try:
+        pic = convert_url2pic(url, http, cache, size, timeout)
+    except Exception:
+        pic = None
+    return pic
+
+
+def convert_url2pic(url, http, cache=None, size=(715, 330), timeout=None):
+    with metrics.stage('posters'):
+        return load_url2pic(url, http, cache, size, timeout)
+
+
+def load_url2pic(url, http, cache=None, size=(715, 330), timeout=None):
+    import cv2
+    import numpy
+    if cache is not None:
+        pic = cache.load_array(url, size)
+        if pic is not None:
+            return pic
+        data = cache.load(url)
+    else:
+        data = None
+    if data is None:
+        response = http.get(url, timeout=timeout, retry=timeout is None)
+        response.raise_for_status()
+        data = response.content
+    pic = numpy.frombuffer(data, dtype='uint8')
     pic = cv2.imdecode(pic, cv2.IMREAD_COLOR)
     pic = cv2.resize(pic, size)
+    if cache is not None:
+        cache.store(url, data)
+        cache.store_array(url, size, pic)
     return pic
 
 
-def parse_data_from_entry(entry):
+def parse_data_from_entry(entry, http):
     entry_link = entry['link']
-    episode = extractor(entry_link)
     entry_date = datetime(*entry['published_parsed'][:3]).date()
-    if not episode['poster']:
-        episode['poster'] = poster_from_data(entry['summary'])
-    episode['date'] = entry_date
+    episode = extractor(entry_link, http, date=entry_date)
+    if episode is not None and not episode.poster:
+        episode = replace(episode, poster=poster_from_data(entry['summary']))
     return episode
 
 
-def extractor(url):
+def try_parse_data_from_entry(entry, http):
+    try:
+        episode = parse_data_from_entry(entry, http)
+    except (AttributeError, requests.RequestException):
+        episode = None
+    return episode
+
+
+def fetch_entries(entries, http, workers):
+    if not entries:
+        return []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        episodes = list(executor.map(try_parse_data_from_entry, entries, repeat(http)))
+    return episodes
+
+
+def try_extractor(url, http):
+    try:
+        episode = extractor(url, http)
+    except (AttributeError, requests.RequestException):
+        episode = None
+    return episode
+
+
+def extractor(url, http, date=None):
     url = url.replace('/mr/', '/')
+    with metrics.stage('pages'):
+        response = http.get(url)
+    if response.status_code != 200:
+        return None
+    with metrics.stage('page_parse'):
+        title, og_image, og_description = page_meta(response.text)
+    episode = episode_info_from_data(
+        title,
+        description=og_description.replace('&nbsp;', ''),
+        url=url,
+        poster=og_image,
+        date=date,
+    )
+    return episode
+
+
+def page_meta(text):
+    head = HeadMetaParser()
+    head.parse(text)
+    if head.title is not None:
+        return head.title, head.meta.get('og:image', ''), head.meta.get('og:description', '')
+    return page_meta_soup(text)
+
+
+def page_meta_soup(text):
+    from bs4 import BeautifulSoup
     og_image = ''
     og_description = ''
-    episode = {}
-    response = requests.get(url)
-    if response.status_code == 200:
-        episode_page = BeautifulSoup(response.text, features='html.parser')
-        try:
-            og_image = episode_page.find('meta', {'property': 'og:image'}).get('content')
-        except AttributeError:
-            pass
-        try:
-            og_description = episode_page.find('meta', {'property': 'og:description'}).get('content')
-        except AttributeError:
-            pass
-        episode = episode_info_from_data(episode_page.title.text)
-        episode['poster'] = og_image
-        episode['description'] = og_description.replace('&nbsp;', '')
-        episode['url'] = url
-    return episode
+    page = BeautifulSoup(text, features='html.parser')
+    try:
+        og_image = page.find('meta', {'property': 'og:image'}).get('content')
+    except AttributeError:
+        pass
+    try:
+        og_description = page.find('meta', {'property': 'og:description'}).get('content')
+    except AttributeError:
+        pass
+    return page.title.text, og_image, og_description
+
+
+def schedule_date_key(episode):
+    return episode.date
+
+
+def parse_schedule_page(text, source):
+    from bs4 import BeautifulSoup, SoupStrainer
+    schedule = BeautifulSoup(text, features='html.parser', parse_only=SoupStrainer(['meta', 'tr']))
+    blank_logo = schedule.find('meta', property='og:image').get('content')
+    section = ''
+    rows = []
+    for line in schedule.find_all('tr'):
+        columns = {}
+        for cell in line.find_all(['th', 'td'], recursive=False):
+            if cell.name == 'th':
+                if cell.get('colspan') == '6':
+                    section = cell.text
+                break
+            columns[cell.get('class', [''])[0]] = cell
+        if len(columns) >= 4:
+            labels = {}
+            for div in line.find_all('div'):
+                classes = div.get('class', [])
+                for label in (*classes, ' '.join(classes)):
+                    labels.setdefault(label, div.text)
+            rows.append((section, schedule_entry(columns, labels, source)))
+    return blank_logo, rows
+
+
+def schedule_entry(columns, labels, source):
+    column_alpha, column_beta, column_gamma, column_delta = (
+        columns['alpha'], columns['beta'], columns['gamma'], columns['delta']
+    )
+    poster = poster_from_data(urljoin('http:', column_alpha.img.get('src')))
+    [name, _, name_ru] = [x.text for x in column_gamma]
+    if name_ru:
+        name, name_ru = name_ru, name
+    ep_date = datetime.strptime(PATTERN_SCHEDULE_DATE.findall(column_delta.text)[0], '%d.%m.%Y').date()
+    is_movie = ''.join(labels.get('serie-number-box', '').split()) == 'Фильм'
+    if is_movie:
+        re_url = PATTERN_SCHEDULE_MOVIE_URL.match(column_beta.get('onclick'))
+        return Movie(name=name, name_ru=name_ru, url=urljoin(source, re_url[1]), poster=poster, date=ep_date)
+    season_episode = labels['count']
+    re_season_episode = PATTERN_SCHEDULE_SEASON_EPISODE.match(season_episode)
+    if re_season_episode:
+        season_number, number = re_season_episode.group(1, 2)
+    else:
+        season_number = 999
+        number = PATTERN_SCHEDULE_SPECIAL.match(season_episode).group(1)
+    re_url = PATTERN_SCHEDULE_SERIES_URL.match(column_beta.get('onclick'))
+    return Episode(
+        show_name=labels['en small-text'],
+        show_name_ru=labels['ru'],
+        season_number=int(season_number),
+        number=int(number),
+        name=name,
+        name_ru=name_ru,
+        url=urljoin(source, re_url[1]),
+        poster=poster,
+        date=ep_date,
+    )
+
+
+class HeadMetaParser(HTMLParser):
+
+    properties = ('og:image', 'og:description')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.meta = {}
+        self.in_title = False
+        self.done = False
+
+    def parse(self, text, chunk_size=4096):
+        for start in range(0, len(text), chunk_size):
+            self.feed(text[start:start + chunk_size])
+            if self.done:
+                break
+        else:
+            self.close()
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'title' and self.title is None:
+            self.title = ''
+            self.in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            meta_property = attrs.get('property')
+            if meta_property in self.properties and meta_property not in self.meta:
+                self.meta[meta_property] = attrs.get('content')
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
 
 
 class BaseModel(peewee.Model):
@@ -243,7 +578,7 @@ class BaseModel(peewee.Model):
 
 class Episodes(BaseModel):
     id = peewee.IntegerField()
-    date = peewee.DateTimeField()
+    date = peewee.DateTimeField(index=True)
     show_name_ru = peewee.CharField()
     show_name = peewee.CharField()
     season_number = peewee.IntegerField()
@@ -253,297 +588,921 @@ class Episodes(BaseModel):
     description = peewee.TextField()
     url = peewee.CharField()
     poster = peewee.CharField()
+    checked = peewee.DateTimeField(null=True)
+    attempts = peewee.IntegerField(default=0)
+    next_check = peewee.DateTimeField(null=True, index=True)
+
+    class Meta:
+        indexes = (
+            (('show_name', 'season_number', 'number'), False),
+        )
 
 
 class Movies(BaseModel):
     id = peewee.IntegerField()
-    date = peewee.DateTimeField()
+    date = peewee.DateTimeField(index=True)
     name_ru = peewee.CharField()
-    name = peewee.CharField()
+    name = peewee.CharField(index=True)
     description = peewee.TextField()
     url = peewee.CharField()
     poster = peewee.CharField()
+    checked = peewee.DateTimeField(null=True)
+    attempts = peewee.IntegerField(default=0)
+    next_check = peewee.DateTimeField(null=True, index=True)
 
 
 class Schedule(BaseModel):
     id = peewee.IntegerField()
-    date = peewee.DateTimeField()
-    fingerprint = peewee.IntegerField()
+    date = peewee.DateTimeField(index=True)
+    fingerprint = peewee.CharField(index=True)
+    chat = peewee.CharField(null=True)
+    section = peewee.CharField(null=True)
+    posters = peewee.CharField(null=True, index=True)
+
+
+class Messages(BaseModel):
+    chat = peewee.CharField()
+    url = peewee.CharField()
+    message_id = peewee.IntegerField()
+    date = peewee.DateTimeField(index=True)
+
+    class Meta:
+        indexes = (
+            (('url', 'chat'), False),
+        )
+
+
+class Outbox(BaseModel):
+    chat = peewee.CharField()
+    is_show = peewee.BooleanField()
+    payload = peewee.TextField()
+    attempts = peewee.IntegerField(default=0)
+    created = peewee.DateTimeField()
+
+
+class Uploads(BaseModel):
+    key = peewee.CharField()
+    bot = peewee.CharField()
+    file_id = peewee.CharField()
+    date = peewee.DateTimeField(index=True)
+
+    class Meta:
+        indexes = (
+            (('key', 'bot'), True),
+        )
+
+
+def content_key(photo):
+    if isinstance(photo, str):
+        photo = photo.encode('utf8')
+    return sha1(photo).hexdigest()
+
+
+def photo_file_id(message):
+    photos = getattr(message, 'photo', None)
+    if photos:
+        return photos[-1].file_id
+    return None
+
+
+def wrong_file_id(exc):
+    return exc.error_code == 400 and 'file' in str(exc.description).lower()
+
+
+def message_not_modified(exc):
+    return exc.error_code == 400 and 'not modified' in str(exc.description).lower()
+
+
+def message_gone(exc):
+    description = str(exc.description).lower()
+    if exc.error_code == 403:
+        return True
+    return exc.error_code == 400 and any(
+        reason in description for reason in ('not found', "can't be edited", 'message_id_invalid')
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class Episode:
+    show_name: str
+    show_name_ru: str
+    season_number: int
+    number: int
+    name: str
+    name_ru: str
+    description: str = ''
+    url: str = ''
+    poster: str = ''
+    date: date = None
+    is_show = True
+
+    @property
+    def key(self):
+        return self.show_name, self.season_number, self.number
+
+    def to_row(self, **values):
+        return dict(zip(EPISODE_FIELDS, (getattr(self, field) for field in EPISODE_FIELDS)), **values)
+
+
+@dataclass(frozen=True, slots=True)
+class Movie:
+    name: str
+    name_ru: str
+    description: str = ''
+    url: str = ''
+    poster: str = ''
+    date: date = None
+    is_show = False
+
+    @property
+    def key(self):
+        return self.name,
+
+    def to_row(self, **values):
+        return dict(zip(MOVIE_FIELDS, (getattr(self, field) for field in MOVIE_FIELDS)), **values)
+
+
+EPISODE_FIELDS = tuple(field.name for field in fields(Episode))
+MOVIE_FIELDS = tuple(field.name for field in fields(Movie))
+
+
+@dataclass(slots=True)
+class Delivery:
+    entry: object
+    chat: str
+    outbox: Outbox
+
+
+@dataclass(slots=True)
+class Repair:
+    row: BaseModel
+    entry: object
+    repost: bool
+    messages: list = field(default_factory=list)
+    gone: list = field(default_factory=list)
+    failed: bool = False
+
+
+def entry_from_row(row):
+    if isinstance(row, Episodes):
+        entry_type, entry_fields = Episode, EPISODE_FIELDS
+    else:
+        entry_type, entry_fields = Movie, MOVIE_FIELDS
+    values = {field: getattr(row, field) for field in entry_fields}
+    if isinstance(values['date'], datetime):
+        values['date'] = values['date'].date()
+    return entry_type(**values)
+
+
+def entry_to_json(entry):
+    values = entry.to_row(date=entry.date.isoformat())
+    return json.dumps(values, ensure_ascii=False)
+
+
+def entry_from_json(payload, is_show):
+    values = json.loads(payload)
+    entry_type, entry_fields = (Episode, EPISODE_FIELDS) if is_show else (Movie, MOVIE_FIELDS)
+    values = {field: values[field] for field in entry_fields if field in values}
+    values['date'] = date.fromisoformat(values['date'])
+    return entry_type(**values)
+
+
+def migrate_schema(db, models):
+    migrator = SchemaMigrator.from_database(db)
+    operations = []
+    for model in models:
+        table = model._meta.table_name
+        if not db.table_exists(table):
+            continue
+        columns = {column.name: column for column in db.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            column = columns.get(field.column_name)
+            if column is None:
+                operations.append(migrator.add_column(table, field.column_name, field))
+            elif isinstance(field, peewee.CharField) and column.data_type.upper() in ('INT', 'INTEGER'):
+                operations.append(migrator.alter_column_type(table, field.column_name, peewee.CharField()))
+    if operations:
+        with db.atomic():
+            migrate(*operations)
+
+
+def open_database(db_url, pool_size=4, stale_timeout=300, mmap_size=64 * 1024 ** 2, busy_timeout=5):
+    scheme = db_url.split(':', 1)[0]
+    options = {}
+    if pool_size and '+pool' not in scheme and f'{scheme}+pool' in db_schemes and not scheme.startswith('sqlite'):
+        db_url = f'{scheme}+pool{db_url[len(scheme):]}'
+        scheme += '+pool'
+    if scheme.endswith('+pool'):
+        options['max_connections'] = pool_size or None
+        options['stale_timeout'] = stale_timeout
+    if scheme.startswith('sqlite'):
+        options['timeout'] = busy_timeout
+        options['pragmas'] = {
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'mmap_size': mmap_size,
+            'busy_timeout': int(busy_timeout * 1000),
+        }
+    return connect(db_url, **options)
 
 
 class Parser:
 
-    def __init__(self):
-        self.settings = Conf()
-        self.today_utc = datetime.utcnow().date()
-        self.old_entries_frontier = self.today_utc - timedelta(days=self.settings.db_episode_lifetime)
-        self.db = connect(self.settings.db_url)
+    def __init__(self, settings=None, http=None, state=None, feed_response=None):
+        self.settings = settings or Conf()
+        self.state = state or RunState(self.settings.state_file)
+        self.db = open_database(
+            self.settings.db_url,
+            pool_size=self.settings.db_pool_size,
+            stale_timeout=self.settings.db_stale_timeout,
+            mmap_size=self.settings.db_mmap_size,
+            busy_timeout=self.settings.db_busy_timeout,
+        )
         self.episodes = Episodes
         self.movies = Movies
         self.schedule = Schedule
+        self.outbox = Outbox
+        self.messages = Messages
+        self.uploads = Uploads
+        self.chats = self.settings.chats
+        self.primary_chat = self.chats[0].chatid
         db_proxy.initialize(self.db)
-        self.db.create_tables([self.episodes, self.movies, self.schedule])
-        self.feed = feed_parse(self.settings.rss)
-        self.bot = TlgrmBot(self.settings.botid, self.settings.chatid)
-        self.new_episodes = []
+        models = [self.episodes, self.movies, self.schedule, self.outbox, self.messages, self.uploads]
+        migrate_schema(self.db, models)
+        messages_exist = self.messages.table_exists()
+        self.db.create_tables(models)
+        if not messages_exist:
+            self.backfill_messages()
+        self.http = http or HttpClient.from_settings(self.settings)
+        self.poster_cache = PosterCache(
+            self.settings.poster_cache_dir,
+            max_size=self.settings.poster_cache_size,
+            max_age=self.settings.poster_cache_age,
+            arrays=self.settings.poster_cache_arrays,
+        )
+        if self.settings.telegram_api:
+            from telebot import apihelper
+            apihelper.API_URL = urljoin(self.settings.telegram_api, 'bot{0}/{1}')
+        self.bots = {chat.chatid: TlgrmBot(chat.botid, chat.chatid) for chat in self.chats}
+        self.bot = self.bots[self.primary_chat]
+        self.delivery = DeliveryQueue(
+            rate=self.settings.send_rate,
+            burst=self.settings.send_burst,
+            retries=self.settings.send_retries,
+        )
         self.timetable = {}
-        self.pattern = r'^(.*) \((.*)\). (.*). \(S(\d+)E(\d+)\)'
-        self.pattern_sp = r'^(.*) \((.*)\). (.*). \((.*) (\d+)\)'
-        self.pattern_movie = r'^(.*) \((.*)\). \(Фильм\)$'
+        self.pattern = PATTERN_ENTRY_EPISODE
+        self.pattern_sp = PATTERN_ENTRY_SPECIAL
+        self.pattern_movie = PATTERN_ENTRY_MOVIE
+        self.refresh(feed_response)
+
+    def transaction(self):
+        if isinstance(self.db, peewee.SqliteDatabase):
+            return self.db.atomic('IMMEDIATE')
+        return self.db.atomic()
+
+    def release_db(self):
+        if isinstance(self.db, PooledDatabase) and not self.db.is_closed():
+            self.db.close()
+
+    def backfill_messages(self):
+        with self.transaction():
+            self.schedule.update(chat=self.primary_chat).where(self.schedule.chat.is_null()).execute()
+            for model in (self.episodes, self.movies):
+                query = model.select(
+                    peewee.Value(self.primary_chat),
+                    model.url,
+                    model.id,
+                    model.date,
+                ).where(model.id > 0)
+                self.messages.insert_from(
+                    query,
+                    [self.messages.chat, self.messages.url, self.messages.message_id, self.messages.date],
+                ).execute()
+
+    def new_day(self):
+        self.today_utc = datetime.utcnow().date()
+        self.old_entries_frontier = self.today_utc - timedelta(days=self.settings.db_episode_lifetime)
+
+    def refresh(self, feed_response=None):
+        self.new_day()
+        self.feed_response = feed_response
+        self.feed_fingerprint = None
+        self.feed_head = None
+        self.feed_complete = True
+        self.schedule_complete = True
+        self.new_episodes = []
+        self.feed = self.fetch_feed()
+
+    def fetch_feed(self):
+        if self.feed_response is None:
+            self.feed_response = fetch_quietly(self.http, self.settings.rss, conditional=True)
+        if self.feed_response is None or self.feed_response.status_code != 200:
+            return {'entries': []}
+        self.feed_fingerprint = feed_fingerprint(self.feed_response.content)
+        if not self.feed_modified():
+            return {'entries': []}
+        mark = self.state.get('feed_mark')
+        with metrics.stage('feed_parse'):
+            try:
+                entries, self.feed_head = entries_above_mark(stream_feed(self.feed_response.content), mark)
+            except (ParseError, KeyError, TypeError, ValueError):
+                from feedparser import parse as feed_parse
+                feed = feed_parse(self.feed_response.content)
+                entries, self.feed_head = entries_above_mark(feed['entries'], mark)
+        return {'entries': entries}
 
     def online(self):
-        if self.feed['status'] == 200:
+        if self.feed_response is not None and self.feed_response.status_code in (200, 304):
             return True
         else:
             return False
 
+    def feed_modified(self):
+        if self.feed_response.status_code != 200:
+            return False
+        return self.feed_fingerprint != self.state.get('feed')
+
     def check_old_episodes(self):
-        for episode in self.episodes.select():
-            if episode.date.date() < self.old_entries_frontier:
-                episode.delete_instance()
-            elif not episode.description or not episode.name_ru or 'poster.jpg' in episode.poster:
-                self.check_missed_data(episode)
-        for movie in self.movies.select():
-            if movie.date.date() < self.old_entries_frontier:
-                movie.delete_instance()
-            elif not movie.description or not movie.name_ru:
-                self.check_missed_data(movie)
-        for schedule in self.schedule.select():
-            if schedule.date.date() < self.old_entries_frontier:
-                schedule.delete_instance()
-
-    def check_missed_data(self, episode):
-        need_upd = False
-        old_description = episode.description
-        old_name_ru = episode.name_ru
-        old_poster = episode.poster
-        episode_new_check = extractor(episode.url)
-        description = episode_new_check['description']
-        name_ru = episode_new_check['name_ru']
-        poster = episode_new_check['poster']
-        if description and not old_description:
-            episode.description = description
-            need_upd = True
-        if name_ru and not old_name_ru:
-            episode.name_ru = name_ru
-            need_upd = True
-        if poster != old_poster:
-            self.bot.edit_poster(episode.id, poster)
-            episode.poster = poster
-            need_upd = True
-        if need_upd:
-            episode.date = episode.date.date()
-            episode_as_dict = model_to_dict(episode)
-            try:
-                caption = generate_episode_caption(episode_as_dict)
-            except KeyError:
-                caption = generate_movie_caption(episode_as_dict)
-            try:
-                self.bot.edit_caption(episode.id, caption)
-            except Exception:
-                pass
+        with metrics.stage('prune'):
+            self.prune_old_entries()
+        with metrics.stage('repair'):
+            self.repair_missed_data()
+        self.state.set('repair', time.time())
+
+    def repair_missed_data(self):
+        now = datetime.utcnow()
+        budget = self.settings.repair_budget
+        candidates = self.episodes_with_missed_data(now, budget) + self.movies_with_missed_data(now, budget)
+        candidates.sort(key=lambda candidate: candidate.next_check or datetime.min)
+        candidates = candidates[:budget]
+        if not candidates:
+            return
+        urls = [candidate.url for candidate in candidates]
+        with ThreadPoolExecutor(max_workers=self.settings.workers) as executor:
+            new_checks = list(executor.map(try_extractor, urls, repeat(self.http)))
+        repairs = []
+        for candidate, episode_new_check in zip(candidates, new_checks):
+            if episode_new_check:
+                repair = self.check_missed_data(candidate, episode_new_check)
+                if repair is not None:
+                    repairs.append(repair)
+        messages = self.messages.select().where(self.messages.url.in_([repair.entry.url for repair in repairs]))
+        by_url = {repair.entry.url: repair for repair in repairs}
+        for message in messages:
+            if message.chat in self.bots:
+                by_url[message.url].messages.append(message)
+        self.edit_messages([(repair, message) for repair in repairs for message in repair.messages])
+        with self.transaction():
+            for candidate in candidates:
+                self.postpone_check(candidate, now)
+            self.store_repairs(repairs)
+
+    def postpone_check(self, episode, now):
+        model = type(episode)
+        delay = min(
+            self.settings.repair_backoff * 2 ** episode.attempts,
+            self.settings.repair_backoff_max,
+        )
+        episode.checked = now
+        episode.attempts += 1
+        episode.next_check = now + timedelta(hours=delay)
+        model.update(
+            checked=episode.checked,
+            attempts=episode.attempts,
+            next_check=episode.next_check,
+        ).where(model.url == episode.url).execute()
+
+    def prune_old_entries(self):
+        with self.transaction():
+            for model in (self.episodes, self.movies, self.schedule, self.messages, self.uploads):
+                model.delete().where(model.date < self.old_entries_frontier).execute()
+
+    def episodes_with_missed_data(self, now, limit):
+        query = self.episodes.select().where(
+            (self.episodes.date >= self.old_entries_frontier)
+            & (self.episodes.id > 0)
+            & (self.episodes.next_check.is_null() | (self.episodes.next_check <= now))
+            & (
+                self.episodes.description.is_null()
+                | (self.episodes.description == '')
+                | self.episodes.name_ru.is_null()
+                | (self.episodes.name_ru == '')
+                | self.episodes.poster.contains('poster.jpg')
+            )
+        ).order_by(self.episodes.next_check).limit(limit)
+        return list(query)
+
+    def movies_with_missed_data(self, now, limit):
+        query = self.movies.select().where(
+            (self.movies.date >= self.old_entries_frontier)
+            & (self.movies.id > 0)
+            & (self.movies.next_check.is_null() | (self.movies.next_check <= now))
+            & (
+                self.movies.description.is_null()
+                | (self.movies.description == '')
+                | self.movies.name_ru.is_null()
+                | (self.movies.name_ru == '')
+            )
+        ).order_by(self.movies.next_check).limit(limit)
+        return list(query)
+
+    def check_missed_data(self, episode, episode_new_check):
+        values = {}
+        if episode_new_check.description and not episode.description:
+            values['description'] = episode_new_check.description
+        if episode_new_check.name_ru and not episode.name_ru:
+            values['name_ru'] = episode_new_check.name_ru
+        if episode_new_check.poster != episode.poster:
+            values['poster'] = episode_new_check.poster
+        if not values:
+            return None
+        return Repair(episode, replace(entry_from_row(episode), **values), 'poster' in values)
+
+    def edit_messages(self, edits, cached=True):
+        from telebot.apihelper import ApiTelegramException
+        jobs = []
+        uploads = []
+        for repair, message in edits:
+            bot = self.bots[message.chat]
+            caption = entry_caption(repair.entry)
+            if repair.repost:
+                poster, key = repair.entry.poster, content_key(repair.entry.poster)
+                if cached:
+                    poster, key = self.cached_photo(bot, poster)
+                uploads.append((key, poster is repair.entry.poster))
+                jobs.append((bot.chatid, partial(bot.edit_poster, message.message_id, poster, caption)))
             else:
-                episode.save()
+                uploads.append((None, False))
+                jobs.append((bot.chatid, partial(bot.edit_caption, message.message_id, caption)))
+        stale = []
+        for number, result in self.delivery.deliver(jobs):
+            repair, message = edits[number]
+            bot = self.bots[message.chat]
+            key, fresh = uploads[number]
+            if not isinstance(result, Exception):
+                if fresh:
+                    self.remember_upload(bot, key, result)
+            elif not isinstance(result, ApiTelegramException) or result.error_code not in (400, 403):
+                repair.failed = True
+            elif wrong_file_id(result):
+                if fresh:
+                    repair.failed = True
+                else:
+                    self.forget_upload(bot, key)
+                    stale.append((repair, message))
+            elif message_gone(result):
+                repair.gone.append(message.id)
+            elif not message_not_modified(result):
+                metrics.count('errors')
+        if stale:
+            self.edit_messages(stale, cached=False)
+
+    def store_repairs(self, repairs):
+        gone = [message_id for repair in repairs for message_id in repair.gone]
+        if gone:
+            self.messages.delete().where(self.messages.id.in_(gone)).execute()
+        for repair in repairs:
+            if repair.failed:
+                continue
+            model = type(repair.row)
+            model.update(
+                date=repair.entry.date,
+                name_ru=repair.entry.name_ru,
+                description=repair.entry.description,
+                poster=repair.entry.poster,
+            ).where(model.url == repair.entry.url).execute()
 
     def check_new_entries(self):
+        keys = []
+        unseen_entries = []
+        pending = self.pending_episodes()
+        pending_keys = {(delivery.entry.is_show, delivery.entry.key) for delivery in pending}
         for entry in self.feed['entries']:
-            is_show = True
             if ' (Фильм)' in entry['title']:
-                elem = self.parse_entry_movie(entry)
-                is_show = False
+                keys.append((False, self.parse_entry_movie(entry)))
             else:
-                elem = self.parse_entry_episode(entry)
-            if not self.episode_in_db(elem, is_show):
-                try:
-                    new_elem = parse_data_from_entry(entry)
-                except AttributeError:
+                keys.append((True, self.parse_entry_episode(entry)))
+        with metrics.stage('dedup'):
+            in_db = self.episodes_in_db(keys)
+        for entry, key, known in zip(self.feed['entries'], keys, in_db):
+            if not known and key not in pending_keys:
+                unseen_entries.append(entry)
+        new_entries = fetch_entries(unseen_entries, self.http, self.settings.workers)
+        scraped = []
+        for new_entry in new_entries:
+            if new_entry is None:
+                self.feed_complete = False
+                continue
+            scraped.append(new_entry)
+        scraped.reverse()
+        unsent = {self.episodes: [], self.movies: []}
+        with self.transaction():
+            for new_entry in scraped:
+                chats = [chat.chatid for chat in self.chats if chat.accepts(new_entry)]
+                if not chats:
+                    unsent[self.episodes if new_entry.is_show else self.movies].append(new_entry.to_row(id=0))
                     continue
-                else:
-                    new_elem['id'] = None
-                    new_elem['is_show'] = is_show
-                    self.new_episodes.append(new_elem)
-        self.new_episodes.reverse()
+                payload = entry_to_json(new_entry)
+                for chat in chats:
+                    outbox = self.outbox.create(
+                        chat=chat,
+                        is_show=new_entry.is_show,
+                        payload=payload,
+                        created=datetime.utcnow(),
+                    )
+                    pending.append(Delivery(new_entry, chat, outbox))
+            for model, rows in unsent.items():
+                if rows:
+                    model.insert_many(rows).execute()
+        self.new_episodes = pending
+        if self.feed_complete and self.feed_head is not None:
+            self.state.set('feed_mark', self.feed_head)
+
+    def pending_episodes(self):
+        pending = []
+        for row in self.outbox.select().order_by(self.outbox.id):
+            if row.chat not in self.bots:
+                row.delete_instance()
+                continue
+            pending.append(Delivery(entry_from_json(row.payload, row.is_show), row.chat, row))
+        return pending
 
     def parse_entry_episode(self, entry):
-        episode = {}
         try:
-            re_entry = re.match(self.pattern, entry['title'])
-            episode['season_number'] = int(re_entry.group(4))
+            re_entry = self.pattern.match(entry['title'])
+            season_number = int(re_entry.group(4))
         except AttributeError:
-            re_entry = re.match(self.pattern_sp, entry['title'])
-            episode['season_number'] = 999
-        episode['show_name'] = re_entry.group(2)
-        episode['number'] = int(re_entry.group(5))
-        return episode
+            re_entry = self.pattern_sp.match(entry['title'])
+            season_number = 999
+        return re_entry.group(2), season_number, int(re_entry.group(5))
 
     def parse_entry_movie(self, entry):
-        movie = {}
-        re_entry = re.match(self.pattern_movie, entry['title'])
-        movie['name'] = re_entry.group(2)
-        return movie
+        re_entry = self.pattern_movie.match(entry['title'])
+        return re_entry.group(2),
 
     def send_new_episodes(self):
-        for episode in self.new_episodes:
-            poster = episode['poster']
-            if episode['is_show']:
-                caption = generate_episode_caption(episode)
-            else:
-                caption = generate_movie_caption(episode)
-            try:
-                message_id = self.bot.send_poster_with_caption(poster, caption).message_id
-            except Exception:
-                self.new_episodes.remove(episode)
+        waves = ([], [])
+        uploading = set()
+        waiting = set()
+        for delivery in self.new_episodes:
+            bot = self.bots[delivery.chat]
+            poster, upload_key = self.cached_photo(bot, delivery.entry.poster)
+            upload = (bot.bot_key, upload_key) if poster is delivery.entry.poster else None
+            if delivery.chat in waiting or (upload is not None and upload in uploading):
+                waiting.add(delivery.chat)
+                waves[1].append(delivery)
             else:
-                episode['id'] = message_id
-        if self.new_episodes:
-            new_episodes = []
-            new_movies = []
-            for elem in self.new_episodes:
-                if elem['is_show']:
-                    del elem['is_show']
-                    new_episodes.append(elem)
+                if upload is not None:
+                    uploading.add(upload)
+                waves[0].append(delivery)
+        for wave in waves:
+            self.deliver_episodes(wave)
+        self.new_episodes = []
+        self.state.set('outbox', self.outbox.select().count())
+        if self.feed_complete and self.feed_fingerprint is not None:
+            self.http.remember(self.settings.rss, self.feed_response)
+            self.state.set('feed', self.feed_fingerprint)
+
+    def deliver_episodes(self, deliveries):
+        from telebot.apihelper import ApiTelegramException
+        jobs = []
+        uploads = []
+        for delivery in deliveries:
+            caption = entry_caption(delivery.entry)
+            bot = self.bots[delivery.chat]
+            poster, upload_key = self.cached_photo(bot, delivery.entry.poster)
+            uploads.append((upload_key, poster is not delivery.entry.poster))
+            jobs.append((bot.chatid, partial(bot.send_poster_with_caption, poster, caption)))
+        for number, result in self.delivery.deliver(jobs):
+            delivery = deliveries[number]
+            bot = self.bots[delivery.chat]
+            upload_key, cached = uploads[number]
+            if not isinstance(result, Exception):
+                self.remember_upload(bot, upload_key, result)
+                self.store_delivered(delivery, result.message_id)
+            elif isinstance(result, ApiTelegramException) and result.error_code in (400, 403):
+                if cached and wrong_file_id(result):
+                    self.forget_upload(bot, upload_key)
                 else:
-                    del elem['is_show']
-                    new_movies.append(elem)
-            self.episodes.insert_many(new_episodes).execute()
-            self.movies.insert_many(new_movies).execute()
-
-    def episode_in_db(self, entry, is_show):
-        if is_show:
-            try:
-                self.episodes.get(
-                    self.episodes.show_name == entry['show_name'],
-                    self.episodes.season_number == entry['season_number'],
-                    self.episodes.number == entry['number'],
-                )
-            except self.episodes.DoesNotExist:
-                return False
-            else:
-                return True
-        else:
+                    self.postpone_delivery(delivery, result)
+
+    def cached_photo(self, bot, photo):
+        key = content_key(photo)
+        upload = self.uploads.get_or_none(self.uploads.key == key, self.uploads.bot == bot.bot_key)
+        if upload is not None:
+            photo = upload.file_id
+        return photo, key
+
+    def remember_upload(self, bot, key, message):
+        file_id = photo_file_id(message)
+        if file_id:
+            with self.transaction():
+                self.forget_upload(bot, key)
+                self.uploads.insert(
+                    key=key,
+                    bot=bot.bot_key,
+                    file_id=file_id,
+                    date=datetime.utcnow(),
+                ).execute()
+
+    def forget_upload(self, bot, key):
+        self.uploads.delete().where(self.uploads.key == key, self.uploads.bot == bot.bot_key).execute()
+
+    def send_cached_photo(self, bot, photo, send):
+        from telebot.apihelper import ApiTelegramException
+        cached, key = self.cached_photo(bot, photo)
+        if cached is not photo:
             try:
-                self.movies.get(self.movies.name == entry['name'])
-            except self.movies.DoesNotExist:
-                return False
+                return self.delivery.send(bot.chatid, partial(send, cached))
+            except ApiTelegramException as exc:
+                if not wrong_file_id(exc):
+                    raise
+                self.forget_upload(bot, key)
+        message = self.delivery.send(bot.chatid, partial(send, photo))
+        self.remember_upload(bot, key, message)
+        return message
+
+    def store_delivered(self, delivery, message_id):
+        entry = delivery.entry
+        model = self.episodes if entry.is_show else self.movies
+        with self.transaction():
+            if not any(self.episodes_in_db([(entry.is_show, entry.key)])):
+                model.insert(entry.to_row(id=message_id)).execute()
+            self.messages.create(chat=delivery.chat, url=entry.url, message_id=message_id, date=entry.date)
+            delivery.outbox.delete_instance()
+
+    def postpone_delivery(self, delivery, exc):
+        outbox = delivery.outbox
+        if outbox.attempts + 1 < self.settings.send_attempts:
+            outbox.attempts += 1
+            outbox.save()
+            return
+        entry = delivery.entry
+        model = self.episodes if entry.is_show else self.movies
+        with self.transaction():
+            if not any(self.episodes_in_db([(entry.is_show, entry.key)])):
+                model.insert(entry.to_row(id=0)).execute()
+            outbox.delete_instance()
+        metrics.count('dropped', stage='telegram')
+        print(f'Dropped {entry.url} for chat {delivery.chat} after {outbox.attempts + 1} attempts: {exc.description}')
+
+    def episodes_in_db(self, keys):
+        show_names = {key[0] for is_show, key in keys if is_show}
+        movie_names = {key[0] for is_show, key in keys if not is_show}
+        known_episodes = set()
+        known_movies = set()
+        if show_names:
+            query = self.episodes.select(
+                self.episodes.show_name,
+                self.episodes.season_number,
+                self.episodes.number,
+            ).where(self.episodes.show_name.in_(show_names))
+            known_episodes = set(query.tuples())
+        if movie_names:
+            query = self.movies.select(self.movies.name).where(self.movies.name.in_(movie_names))
+            known_movies = {name for name, in query.tuples()}
+        in_db = []
+        for is_show, key in keys:
+            if is_show:
+                in_db.append(key in known_episodes)
             else:
-                return True
+                in_db.append(key[0] in known_movies)
+        return in_db
 
     def scheduler(self):
-        try:
-            self.schedule.select().where(self.schedule.date == self.today_utc).get()
-        except self.schedule.DoesNotExist:
-            response = requests.get(self.settings.schedule)
-            response.encoding = 'utf-8'
-            if response.status_code == 200:
-                sections, blank_logo = self.schedule_parse(response)
+        if not self.schedule.select().where(self.schedule.date == self.today_utc).exists():
+            self.schedule_complete = True
+            pages = self.fetch_schedules()
+            if pages:
+                sections, blank_logo = self.merge_schedules(page for _, _, page in pages)
                 self.send_schedules(sections, blank_logo)
-        for entry in self.schedule.select():
-            if entry.date.date() < self.old_entries_frontier:
-                entry.delete_instance()
+                for url, response, _ in pages:
+                    self.http.remember(url, response)
+                self.poster_cache.evict()
+            if not self.schedule_complete:
+                return
+        self.state.set('schedule', self.today_utc.isoformat())
+
+    def fetch_schedules(self):
+        urls = self.settings.schedules
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            pages = list(executor.map(self.fetch_schedule, urls, repeat(True)))
+            if all(page is None for page in pages):
+                return []
+            unchanged = [url for url, page in zip(urls, pages) if page is None]
+            refetched = dict(zip(unchanged, executor.map(self.fetch_schedule, unchanged, repeat(False))))
+        pages = [page or refetched[url] for url, page in zip(urls, pages)]
+        return [(url, *page) for url, page in zip(urls, pages) if page is not None]
+
+    def fetch_schedule(self, url, conditional):
+        with metrics.stage('schedule'):
+            try:
+                response = self.http.get(url, conditional=conditional)
+            except requests.RequestException:
+                metrics.count('errors')
+                self.schedule_complete = False
+                return None
+        if response.status_code != 200:
+            if response.status_code != 304:
+                self.schedule_complete = False
+            return None
+        response.encoding = 'utf-8'
+        with metrics.stage('schedule_parse'):
+            page = parse_schedule_page(response.text, self.settings.source)
+        return response, page
 
     def schedule_parse(self, response):
-        divide = ''
+        return self.merge_schedules([parse_schedule_page(response.text, self.settings.source)])
+
+    def merge_schedules(self, pages):
         sections = []
-        schedule = BeautifulSoup(response.text, features='html.parser')
-        blank_logo = schedule.find('meta', property='og:image').get('content')
-        schedule_lines = schedule.findAll('tr')
-        for line in schedule_lines:
-            try:
-                divide = line.find('th', {'colspan': 6}).text
-            except AttributeError:
-                episode = self.schedule_episode(line)
-                self.timetable[divide].append(episode)
-            else:
-                self.timetable[divide] = []
-                sections.append(divide)
+        blank_logo = None
+        self.timetable = {}
+        seen = set()
+        for page_logo, rows in pages:
+            blank_logo = blank_logo or page_logo
+            for section, episode in rows:
+                if section not in self.timetable:
+                    self.timetable[section] = []
+                    sections.append(section)
+                if (section, episode.url) not in seen:
+                    seen.add((section, episode.url))
+                    self.timetable[section].append(episode)
+        for section in sections:
+            self.timetable[section].sort(key=schedule_date_key)
         return sections, blank_logo
 
-    def schedule_episode(self, episode):
-        is_movie = episode.find('div', {'class': 'serie-number-box'}).text
-        is_movie = is_movie.join(is_movie.split())
-        is_movie = (is_movie == 'Фильм')
-        if is_movie:
-            pattern_url = r"^goTo\('(\/movies\/.*)',false\);$"
-            pattern_date = r'\d{2}.\d{2}.\d{4}'
-            column_alpha = episode.find('td', {'class': 'alpha'})
-            column_beta = episode.find('td', {'class': 'beta'})
-            column_gamma = episode.find('td', {'class': 'gamma'})
-            column_delta = episode.find('td', {'class': 'delta'})
-            poster = poster_from_data(urljoin('http:', column_alpha.find('img').get('src')))
-            re_url = re.match(pattern_url, column_beta.get('onclick'))
-            ep_url = urljoin(self.settings.source, re_url[1])
-            [name, _, name_ru] = [x.text for x in column_gamma]
-            if name_ru:
-                name, name_ru = name_ru, name
-            ep_date = re.findall(pattern_date, column_delta.text)[0]
-            episode = {
-                'name': name,
-                'name_ru': name_ru,
-                'url': ep_url,
-                'poster': poster,
-                'date': ep_date,
-            }
-        else:
-            pattern_senn = r'^(\d{1,3})[ ]сезон[ ](\d{1,3})[ ]серия$'
-            pattern_special = r'^Спецэпизод[ ](\d{1,3})$'
-            pattern_url = r"^goTo\('(\/series\/.*)',false\);$"
-            pattern_date = r'\d{2}.\d{2}.\d{4}'
-            column_alpha = episode.find('td', {'class': 'alpha'})
-            column_beta = episode.find('td', {'class': 'beta'})
-            column_gamma = episode.find('td', {'class': 'gamma'})
-            column_delta = episode.find('td', {'class': 'delta'})
-            poster = poster_from_data(urljoin('http:', column_alpha.find('img').get('src')))
-            show_name = column_alpha.find('div', {'class': 'en small-text'}).text
-            show_name_ru = column_alpha.find('div', {'class': 'ru'}).text
-            season_episode = column_beta.find('div', {'class': 'count'}).text
-            try:
-                re_season_episode = re.match(pattern_senn, season_episode)
-                season_number, number = re_season_episode.group(1, 2)
-            except AttributeError:
-                re_season_episode = re.match(pattern_special, season_episode)
-                season_number = 999
-                number = re_season_episode.group(1)
-            re_url = re.match(pattern_url, column_beta.get('onclick'))
-            ep_url = urljoin(self.settings.source, re_url[1])
-            [name, _, name_ru] = [x.text for x in column_gamma]
-            if name_ru:
-                name, name_ru = name_ru, name
-            ep_date = re.findall(pattern_date, column_delta.text)[0]
-            episode = {
-                'show_name': show_name,
-                'show_name_ru': show_name_ru,
-                'season_number': int(season_number),
-                'number': int(number),
-                'name': name,
-                'name_ru': name_ru,
-                'url': ep_url,
-                'poster': poster,
-                'date': ep_date,
-            }
-        return episode
-
     def send_schedules(self, sections, blank_logo):
         if self.timetable:
             for section in sections:
-                caption = generate_schedule_caption(section, self.timetable[section])
-                caption_fingerprint = fingerprint(caption)
-                try:
-                    self.schedule.get(self.schedule.fingerprint == caption_fingerprint)
-                except self.schedule.DoesNotExist:
-                    posters = []
-                    for episode in self.timetable[section]:
-                        posters.append(episode['poster'])
-                    collage = generate_schedule_collage(blank_logo, posters)
-                    try:
-                        message_id = self.bot.send_poster_with_caption(collage, caption).message_id
-                    except ApiTelegramException:
-                        message = self.bot.send_poster_with_caption(collage, '')
-                        message_id = self.bot.reply_to(message, caption)
-                    self.schedule.create(
-                        id=message_id,
-                        date=self.today_utc,
-                        fingerprint=caption_fingerprint
-                    )
+                renders = {}
+                for chat in self.chats:
+                    if not chat.schedule:
+                        continue
+                    schedule = [
+                        episode for episode in self.timetable[section]
+                        if chat.accepts(episode)
+                    ]
+                    if not schedule:
+                        continue
+                    render_key = tuple(episode.url for episode in schedule)
+                    if render_key not in renders:
+                        caption = generate_schedule_caption(section, schedule)
+                        posters = [episode.poster for episode in schedule]
+                        renders[render_key] = {
+                            'section': section,
+                            'caption': caption,
+                            'fingerprint': fingerprint(caption),
+                            'posters': posters,
+                            'posters_fingerprint': posters_fingerprint(
+                                blank_logo,
+                                posters,
+                                self.settings.collage_tile,
+                                self.settings.collage_quality,
+                                self.settings.collage_pixels,
+                                self.settings.collage_bytes,
+                                self.settings.collage_page,
+                            ),
+                            'collage': None,
+                        }
+                    render = renders[render_key]
+                    if self.schedule.select().where(
+                            self.schedule.fingerprint == render['fingerprint'],
+                            self.schedule.chat == chat.chatid,
+                    ).exists():
+                        continue
+                    bot = self.bots[chat.chatid]
+                    if self.edit_schedule(bot, render):
+                        continue
+                    if render['collage'] is None:
+                        render['collage'] = self.schedule_collage(
+                            blank_logo,
+                            render['posters'],
+                            render['posters_fingerprint'],
+                        )
+                    self.send_schedule(bot, render)
+
+    def schedule_collage(self, blank_logo, posters, collage_fingerprint):
+        pages = []
+        for number, page in enumerate(collage_pages(len(posters), self.settings.collage_page)):
+            cache_key = f'collage:{collage_fingerprint}:{number}'
+            collage = self.poster_cache.load(cache_key)
+            if collage is None:
+                missed = []
+                collage = generate_schedule_collage(
+                    blank_logo,
+                    [posters[position] for position in page],
+                    self.http,
+                    self.poster_cache,
+                    tile_size=self.settings.collage_tile,
+                    quality=self.settings.collage_quality,
+                    workers=self.settings.workers,
+                    timeout=self.settings.poster_timeout,
+                    missed=missed,
+                    max_pixels=self.settings.collage_pixels,
+                    max_bytes=self.settings.collage_bytes,
+                    min_quality=self.settings.collage_min_quality,
+                )
+                if not missed:
+                    self.poster_cache.store(cache_key, collage)
+            pages.append(collage)
+        return pages
+
+    def edit_schedule(self, bot, render):
+        from telebot.apihelper import ApiTelegramException
+        if not self.settings.schedule_edit_days:
+            return False
+        previous = self.schedule.select().where(
+            self.schedule.posters == render['posters_fingerprint'],
+            self.schedule.chat == bot.chatid,
+            self.schedule.section == render['section'],
+            self.schedule.date < self.today_utc,
+            self.schedule.date >= self.today_utc - timedelta(days=self.settings.schedule_edit_days),
+        ).order_by(self.schedule.date.desc()).first()
+        if previous is None:
+            return False
+        try:
+            self.delivery.send(bot.chatid, partial(bot.edit_caption, previous.id, render['caption']))
+        except ApiTelegramException:
+            return False
+        self.schedule.update(
+            date=self.today_utc,
+            fingerprint=render['fingerprint'],
+        ).where(
+            self.schedule.id == previous.id,
+            self.schedule.chat == bot.chatid,
+        ).execute()
+        return True
+
+    def send_schedule(self, bot, render):
+        from telebot.apihelper import ApiTelegramException
+        chat = bot.chatid
+        pages = render['collage']
+        caption = render['caption']
+        posters = render['posters_fingerprint']
+        try:
+            message = self.send_collage(bot, pages, caption)
+            message_id = message.message_id
+        except ApiTelegramException:
+            message = self.send_collage(bot, pages, '')
+            message_id = self.delivery.send(chat, partial(bot.reply_to, message, caption))
+            posters = None
+        self.schedule.create(
+            id=message_id,
+            date=self.today_utc,
+            fingerprint=render['fingerprint'],
+            chat=chat,
+            section=render['section'],
+            posters=posters,
+        )
+
+    def send_collage(self, bot, pages, caption):
+        if len(pages) == 1:
+            return self.send_cached_photo(bot, pages[0], partial(bot.send_poster_with_caption, caption=caption))
+        return self.send_cached_group(bot, pages, caption)[0]
+
+    def send_cached_group(self, bot, photos, caption):
+        from telebot.apihelper import ApiTelegramException
+        cached = [self.cached_photo(bot, photo) for photo in photos]
+        keys = [key for _, key in cached]
+        messages = None
+        if any(cached_photo is not photo for (cached_photo, _), photo in zip(cached, photos)):
+            try:
+                messages = self.delivery.send(
+                    bot.chatid,
+                    partial(bot.send_posters_group, [cached_photo for cached_photo, _ in cached], caption),
+                )
+            except ApiTelegramException as exc:
+                if not wrong_file_id(exc):
+                    raise
+                for key in keys:
+                    self.forget_upload(bot, key)
+        if messages is None:
+            messages = self.delivery.send(bot.chatid, partial(bot.send_posters_group, photos, caption))
+        for key, message in zip(keys, messages):
+            self.remember_upload(bot, key, message)
+        return messages
+
+
+class ChatSettings:
+
+    def __init__(self, name, botid, chatid, content='all', shows=None, schedule=True):
+        self.name = name
+        self.botid = botid
+        self.chatid = chatid
+        self.content = content
+        self.shows = set(shows or [])
+        self.schedule = schedule
+
+    def accepts(self, entry):
+        if self.content == 'shows' and not entry.is_show:
+            return False
+        if self.content == 'movies' and entry.is_show:
+            return False
+        if entry.is_show and self.shows:
+            return entry.show_name.lower() in self.shows or entry.show_name_ru.lower() in self.shows
+        return True
 
 
 class Conf:
@@ -556,11 +1515,57 @@ class Conf:
         self.config.read(self.config_file)
         self.botid = self.read('Settings', 'botid')
         self.chatid = self.read('Settings', 'chatid')
+        self.chats = [self.read_chat('Settings')]
+        for section in self.config.sections():
+            if section.startswith('Chat '):
+                self.chats.append(self.read_chat(section))
         self.source = self.read('System', 'source')
         self.rss = urljoin(self.source, 'rss.xml')
-        self.schedule = urljoin(self.source, 'schedule/type_0')
+        self.schedules = [
+            urljoin(self.source, f'schedule/{page.strip()}')
+            for page in self.read('System', 'schedule_pages', 'type_0').split(',') if page.strip()
+        ]
+        self.schedule = self.schedules[0]
+        self.schedule_edit_days = int(self.read('System', 'schedule_edit_days', '1'))
         self.db_url = self.db_url_insert_path(self.read('System', 'db'))
         self.db_episode_lifetime = int(self.read('System', 'lifetime'))
+        self.db_pool_size = int(self.read('System', 'db_pool_size', '4'))
+        self.db_stale_timeout = float(self.read('System', 'db_stale_timeout', '300'))
+        self.db_mmap_size = int(self.read('System', 'db_mmap_size', '64')) * 1024 ** 2
+        self.db_busy_timeout = float(self.read('System', 'db_busy_timeout', '5'))
+        self.workers = int(self.read('System', 'workers', '8'))
+        self.http_timeout = float(self.read('System', 'timeout', '30'))
+        self.http_retries = int(self.read('System', 'retries', '3'))
+        self.http_backoff = float(self.read('System', 'backoff', '0.5'))
+        self.http_cache = os.path.join(self.work_dir, 'http_cache.json')
+        self.state_file = os.path.join(self.work_dir, 'state.json')
+        self.poster_cache_dir = os.path.join(self.work_dir, 'posters')
+        self.poster_cache_size = int(self.read('System', 'poster_cache_size', '200')) * 1024 ** 2
+        self.poster_cache_age = int(self.read('System', 'poster_cache_age', '30'))
+        self.poster_cache_arrays = self.config.getboolean('System', 'poster_cache_arrays', fallback=False)
+        self.collage_tile = self.size_from_string(self.read('System', 'collage_tile', '715x330'))
+        self.collage_quality = int(self.read('System', 'collage_quality', '95'))
+        self.collage_min_quality = int(self.read('System', 'collage_min_quality', '60'))
+        self.collage_pixels = int(float(self.read('System', 'collage_megapixels', '8')) * 1000 ** 2)
+        self.collage_bytes = int(float(self.read('System', 'collage_megabytes', '5')) * 1024 ** 2)
+        self.collage_page = int(self.read('System', 'collage_page', '20'))
+        self.poster_timeout = float(self.read('System', 'poster_timeout', '10'))
+        self.repair_budget = int(self.read('System', 'repair_budget', '20'))
+        self.repair_backoff = float(self.read('System', 'repair_backoff', '1'))
+        self.repair_backoff_max = float(self.read('System', 'repair_backoff_max', '168'))
+        self.send_rate = float(self.read('System', 'send_rate', '20'))
+        self.send_burst = int(self.read('System', 'send_burst', '3'))
+        self.send_retries = int(self.read('System', 'send_retries', '3'))
+        self.send_attempts = int(self.read('System', 'send_attempts', '5'))
+        self.telegram_api = self.read('System', 'telegram_api', '')
+        self.metrics_file = self.work_path(self.read('System', 'metrics', 'metrics.jsonl'))
+        self.metrics_textfile = self.work_path(self.read('System', 'metrics_textfile', ''))
+        self.feed_interval = float(self.read('Daemon', 'feed_interval', '60'))
+        self.repair_interval = float(self.read('Daemon', 'repair_interval', '3600'))
+        self.schedule_interval = float(self.read('Daemon', 'schedule_interval', '900'))
+        self.jitter = float(self.read('Daemon', 'jitter', '15'))
+        self.metrics_host = self.read('Daemon', 'metrics_host', '127.0.0.1')
+        self.metrics_port = int(self.read('Daemon', 'metrics_port', '0'))
 
     def exist(self):
         if not os.path.isdir(self.work_dir):
@@ -579,17 +1584,81 @@ class Conf:
         self.config.set('System', 'source', 'https://www.lostfilmtv5.site')
         self.config.set('System', 'db', 'sqlite:///entries.db')
         self.config.set('System', 'lifetime', '90')
+        self.config.set('System', 'schedule_pages', 'type_0')
+        self.config.set('System', 'schedule_edit_days', '1')
+        self.config.set('System', 'db_pool_size', '4')
+        self.config.set('System', 'db_stale_timeout', '300')
+        self.config.set('System', 'db_mmap_size', '64')
+        self.config.set('System', 'db_busy_timeout', '5')
+        self.config.set('System', 'workers', '8')
+        self.config.set('System', 'timeout', '30')
+        self.config.set('System', 'retries', '3')
+        self.config.set('System', 'backoff', '0.5')
+        self.config.set('System', 'poster_cache_size', '200')
+        self.config.set('System', 'poster_cache_age', '30')
+        self.config.set('System', 'poster_cache_arrays', 'no')
+        self.config.set('System', 'collage_tile', '715x330')
+        self.config.set('System', 'collage_quality', '95')
+        self.config.set('System', 'collage_min_quality', '60')
+        self.config.set('System', 'collage_megapixels', '8')
+        self.config.set('System', 'collage_megabytes', '5')
+        self.config.set('System', 'collage_page', '20')
+        self.config.set('System', 'poster_timeout', '10')
+        self.config.set('System', 'repair_budget', '20')
+        self.config.set('System', 'repair_backoff', '1')
+        self.config.set('System', 'repair_backoff_max', '168')
+        self.config.set('System', 'send_rate', '20')
+        self.config.set('System', 'send_burst', '3')
+        self.config.set('System', 'send_retries', '3')
+        self.config.set('System', 'send_attempts', '5')
+        self.config.set('System', 'telegram_api', '')
+        self.config.set('System', 'metrics', 'metrics.jsonl')
+        self.config.set('System', 'metrics_textfile', '')
+        self.config.add_section('Daemon')
+        self.config.set('Daemon', 'feed_interval', '60')
+        self.config.set('Daemon', 'repair_interval', '3600')
+        self.config.set('Daemon', 'schedule_interval', '900')
+        self.config.set('Daemon', 'jitter', '15')
+        self.config.set('Daemon', 'metrics_host', '127.0.0.1')
+        self.config.set('Daemon', 'metrics_port', '0')
         with open(self.config_file, 'w') as config_file:
             self.config.write(config_file)
         raise FileNotFoundError(f'Required to fill data in config (section [Settings]): {self.config_file}')
 
-    def read(self, section, setting):
-        value = self.config.get(section, setting)
+    def read(self, section, setting, fallback=None):
+        if fallback is None:
+            value = self.config.get(section, setting)
+        else:
+            value = self.config.get(section, setting, fallback=fallback)
         return value
 
+    def read_chat(self, section):
+        shows = self.read(section, 'shows', '')
+        chat = ChatSettings(
+            name=section[len('Chat '):].strip() if section.startswith('Chat ') else 'default',
+            botid=self.read(section, 'botid', self.botid),
+            chatid=self.read(section, 'chatid'),
+            content=self.read(section, 'content', 'all'),
+            shows=[show.strip().lower() for show in shows.split(',') if show.strip()],
+            schedule=self.config.getboolean(section, 'schedule', fallback=True),
+        )
+        return chat
+
+    def work_path(self, path):
+        if not path:
+            return None
+        return os.path.join(self.work_dir, path)
+
+    @staticmethod
+    def size_from_string(size):
+        width, height = size.lower().split('x')
+        return int(width), int(height)
+
     def db_url_insert_path(self, db_url):
-        pattern = r'(^[A-z]*:\/\/\/)(.*$)'
+        pattern = r'(^sqlite[a-z+]*:\/\/\/)(.*$)'
         parse = re.match(pattern, db_url)
+        if parse is None or parse.group(2) in ('', ':memory:'):
+            return db_url
         prefix = parse.group(1)
         db_name = parse.group(2)
         path = os.path.join(self.work_dir, db_name)
@@ -597,11 +1666,501 @@ class Conf:
         return db_converted_url
 
 
+def fetch_quietly(http, url, conditional=False):
+    with metrics.stage('feed'):
+        try:
+            response = http.get(url, conditional=conditional)
+        except requests.RequestException:
+            metrics.count('errors')
+            response = None
+    return response
+
+
+def idle_run(settings, state, feed_response):
+    today_utc = datetime.utcnow().date()
+    if state.get('schedule') != today_utc.isoformat() or state.get('outbox'):
+        return False
+    if time.time() - state.get('repair', 0) >= settings.repair_interval:
+        return False
+    if feed_response is None or feed_response.status_code == 304:
+        return True
+    if feed_response.status_code != 200:
+        return True
+    return feed_fingerprint(feed_response.content) == state.get('feed')
+
+
+class Daemon:
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.settings = parser.settings
+        self.stop_event = threading.Event()
+        self.tasks = (
+            (self.check_feed, self.settings.feed_interval),
+            (self.check_old_episodes, self.settings.repair_interval),
+            (self.check_schedule, self.settings.schedule_interval),
+        )
+
+    def stop(self, signum=None, frame=None):
+        self.stop_event.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if not self.wait_for_bot():
+            self.parser.db.close()
+            return
+        metrics_server = self.serve_metrics()
+        next_runs = [time.monotonic()] * len(self.tasks)
+        while not self.stop_event.is_set():
+            for number, (task, interval) in enumerate(self.tasks):
+                if self.stop_event.is_set():
+                    break
+                if next_runs[number] <= time.monotonic():
+                    try:
+                        task()
+                    except Exception:
+                        metrics.count('errors')
+                        traceback.print_exc()
+                    self.parser.release_db()
+                    self.flush_metrics(task.__name__)
+                    next_runs[number] = time.monotonic() + interval + random.uniform(0, self.settings.jitter)
+            self.stop_event.wait(max(min(next_runs) - time.monotonic(), 0))
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        self.parser.db.close()
+
+    def wait_for_bot(self):
+        delay = min(5, self.settings.feed_interval)
+        while not self.parser.bot.alive():
+            print(f'Telegram Bot API is unreachable, retrying in {delay:g} s', flush=True)
+            if self.stop_event.wait(delay):
+                return False
+            delay = min(delay * 2, self.settings.feed_interval)
+        return True
+
+    def serve_metrics(self):
+        if not self.settings.metrics_port:
+            return None
+        server = ThreadingHTTPServer((self.settings.metrics_host, self.settings.metrics_port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def flush_metrics(self, run):
+        try:
+            metrics.flush(run, self.settings.metrics_file, self.settings.metrics_textfile)
+        except OSError:
+            traceback.print_exc()
+
+    def check_feed(self):
+        self.parser.refresh()
+        if self.parser.online():
+            self.parser.check_new_entries()
+            self.parser.send_new_episodes()
+
+    def check_old_episodes(self):
+        self.parser.new_day()
+        self.parser.check_old_episodes()
+
+    def check_schedule(self):
+        self.parser.new_day()
+        self.parser.scheduler()
+
+
+class HttpClient:
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.http_cache,
+            timeout=settings.http_timeout,
+            retries=settings.http_retries,
+            backoff=settings.http_backoff,
+            pool_size=settings.workers,
+        )
+
+    def __init__(self, cache_file, timeout=30, retries=3, backoff=0.5, pool_size=8):
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET', 'HEAD'),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.single_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.single_session.mount('http://', adapter)
+        self.single_session.mount('https://', adapter)
+        self.validators = self.load_validators()
+
+    def load_validators(self):
+        try:
+            with open(self.cache_file) as cache_file:
+                validators = json.load(cache_file)
+        except (FileNotFoundError, ValueError):
+            validators = {}
+        return validators
+
+    def save_validators(self):
+        temp_file = self.cache_file + '.tmp'
+        with open(temp_file, 'w') as cache_file:
+            json.dump(self.validators, cache_file)
+        os.replace(temp_file, self.cache_file)
+
+    def get(self, url, conditional=False, timeout=None, retry=True):
+        headers = {}
+        if conditional:
+            validator = self.validators.get(url, {})
+            if validator.get('etag'):
+                headers['If-None-Match'] = validator['etag']
+            if validator.get('last_modified'):
+                headers['If-Modified-Since'] = validator['last_modified']
+        session = self.session if retry else self.single_session
+        response = session.get(url, headers=headers, timeout=timeout or self.timeout)
+        metrics.count('bytes', len(response.content))
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            metrics.count('retries', len(retries.history))
+        return response
+
+    def remember(self, url, response):
+        if response is None or response.status_code != 200:
+            return
+        validator = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        if validator['etag'] or validator['last_modified']:
+            self.validators[url] = validator
+        else:
+            self.validators.pop(url, None)
+        self.save_validators()
+
+
+class RunState:
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        try:
+            with open(self.state_file) as state_file:
+                self.values = json.load(state_file)
+        except (FileNotFoundError, ValueError):
+            self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        if self.values.get(key) == value:
+            return
+        self.values[key] = value
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w') as state_file:
+            json.dump(self.values, state_file)
+        os.replace(temp_file, self.state_file)
+
+
+class Metrics:
+    counters = ('calls', 'seconds', 'bytes', 'retries', 'errors', 'dropped')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = {}
+        self.runs = {}
+        self.last_run = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else 'run'
+
+    @contextmanager
+    def stage(self, name):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(name)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count('errors')
+            raise
+        finally:
+            self.local.stack.pop()
+            self.count('calls', stage=name)
+            self.count('seconds', time.perf_counter() - started, stage=name)
+
+    def count(self, counter, value=1, stage=None):
+        stage = stage or self.current()
+        with self.lock:
+            for stages in (self.stages, self.totals):
+                stats = stages.setdefault(stage, dict.fromkeys(self.counters, 0))
+                stats[counter] += value
+
+    def record(self, run):
+        with self.lock:
+            stages = {
+                stage: dict(stats, seconds=round(stats['seconds'], 4))
+                for stage, stats in sorted(self.stages.items())
+            }
+            return {
+                'time': datetime.utcfromtimestamp(self.started).isoformat(timespec='seconds'),
+                'run': run,
+                'seconds': round(time.time() - self.started, 4),
+                'stages': stages,
+            }
+
+    def flush(self, run, log_file=None, textfile=None, max_size=10 * 1024 ** 2):
+        record = self.record(run)
+        with self.lock:
+            self.runs[run] = self.runs.get(run, 0) + 1
+            self.last_run = time.time()
+        if log_file:
+            try:
+                if os.path.getsize(log_file) > max_size:
+                    os.replace(log_file, log_file + '.1')
+            except OSError:
+                pass
+            with open(log_file, 'a') as metrics_file:
+                metrics_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        if textfile:
+            temp_file = f'{textfile}.{os.getpid()}.tmp'
+            with open(temp_file, 'w') as metrics_file:
+                metrics_file.write(self.prometheus())
+            os.replace(temp_file, textfile)
+        self.reset()
+        return record
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for counter in self.counters:
+                metric = f'lostfilm_stage_{counter}_total'
+                lines.append(f'# TYPE {metric} counter')
+                for stage, stats in sorted(self.totals.items()):
+                    lines.append(f'{metric}{{stage="{stage}"}} {stats[counter]:g}')
+            lines.append('# TYPE lostfilm_runs_total counter')
+            for run, runs in sorted(self.runs.items()):
+                lines.append(f'lostfilm_runs_total{{run="{run}"}} {runs}')
+            lines.append('# TYPE lostfilm_last_run_timestamp_seconds gauge')
+            lines.append(f'lostfilm_last_run_timestamp_seconds {self.last_run:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PosterCache:
+
+    def __init__(self, cache_dir, max_size=200 * 1024 ** 2, max_age=30, arrays=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age * 24 * 60 * 60
+        self.arrays = arrays
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key, suffix):
+        name = sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, name + suffix)
+
+    def array_path(self, url, size):
+        return self.path(f'{url}@{size[0]}x{size[1]}', '.npy')
+
+    def fresh(self, path):
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return False
+        if time.time() - modified > self.max_age:
+            return False
+        os.utime(path)
+        return True
+
+    def write(self, path, write_data):
+        temp_file = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_file, 'wb') as cache_file:
+            write_data(cache_file)
+        os.replace(temp_file, path)
+
+    def load(self, url):
+        path = self.path(url, '.jpg')
+        if not self.fresh(path):
+            return None
+        with open(path, 'rb') as cache_file:
+            data = cache_file.read()
+        return data
+
+    def store(self, url, data):
+        path = self.path(url, '.jpg')
+        if not self.fresh(path):
+            self.write(path, lambda cache_file: cache_file.write(data))
+
+    def load_array(self, url, size):
+        if not self.arrays:
+            return None
+        path = self.array_path(url, size)
+        if not self.fresh(path):
+            return None
+        import numpy
+        try:
+            pic = numpy.load(path, mmap_mode='r')
+        except ValueError:
+            return None
+        return pic
+
+    def store_array(self, url, size, pic):
+        import numpy
+        if self.arrays:
+            path = self.array_path(url, size)
+            if not self.fresh(path):
+                self.write(path, lambda cache_file: numpy.save(cache_file, pic))
+
+    def evict(self):
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.max_age:
+                os.remove(entry.path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def hold(self, seconds):
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class DeliveryQueue:
+
+    def __init__(self, rate=20, burst=3, retries=3):
+        self.rate = rate / 60
+        self.burst = burst
+        self.retries = retries
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, chat):
+        with self.lock:
+            if chat not in self.buckets:
+                self.buckets[chat] = TokenBucket(self.rate, self.burst)
+            return self.buckets[chat]
+
+    def send(self, chat, send):
+        from telebot.apihelper import ApiTelegramException
+        bucket = self.bucket(chat)
+        with metrics.stage('telegram'):
+            for attempt in range(self.retries + 1):
+                bucket.acquire()
+                try:
+                    return send()
+                except ApiTelegramException as exc:
+                    retry_after = retry_after_from_exception(exc)
+                    if retry_after is None or attempt == self.retries:
+                        raise
+                    metrics.count('retries')
+                    bucket.hold(retry_after)
+
+    def deliver_chat(self, chat, jobs, finished):
+        for number, send in jobs:
+            try:
+                result = self.send(chat, send)
+            except Exception as exc:
+                result = exc
+            finished.put((number, result))
+
+    def deliver(self, jobs):
+        chats = {}
+        for number, (chat, send) in enumerate(jobs):
+            chats.setdefault(chat, []).append((number, send))
+        if not chats:
+            return
+        finished = queue.Queue()
+        with ThreadPoolExecutor(max_workers=len(chats)) as executor:
+            for chat, chat_jobs in chats.items():
+                executor.submit(self.deliver_chat, chat, chat_jobs, finished)
+            for _ in range(len(jobs)):
+                yield finished.get()
+
+
+def retry_after_from_exception(exc):
+    if exc.error_code != 429:
+        return None
+    parameters = exc.result_json.get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+
 class TlgrmBot:
 
     def __init__(self, botid, chatid):
         self.botid = botid
+        self.bot_key = botid.split(':')[0]
         self.chatid = chatid
+        from telebot import TeleBot
         self.bot = TeleBot(self.botid)
 
     def send_poster_with_caption(self, poster, caption):
@@ -613,6 +2172,13 @@ class TlgrmBot:
         )
         return message
 
+    def send_posters_group(self, posters, caption):
+        from telebot.types import InputMediaPhoto
+        media = [InputMediaPhoto(posters[0], caption=caption, parse_mode='MarkdownV2')]
+        media.extend(InputMediaPhoto(poster) for poster in posters[1:])
+        messages = self.bot.send_media_group(chat_id=self.chatid, media=media)
+        return messages
+
     def edit_caption(self, message_id, caption):
         self.bot.edit_message_caption(
             caption=caption,
@@ -639,12 +2205,18 @@ class TlgrmBot:
         )
         return reply_message.message_id
 
-    def edit_poster(self, message_id, poster):
-        self.bot.edit_message_media(
+    def edit_poster(self, message_id, poster, caption=None):
+        from telebot.types import InputMediaPhoto
+        if caption is None:
+            media = InputMediaPhoto(poster)
+        else:
+            media = InputMediaPhoto(poster, caption=caption, parse_mode='MarkdownV2')
+        message = self.bot.edit_message_media(
             chat_id=self.chatid,
             message_id=message_id,
-            media=InputMediaPhoto(poster),
+            media=media,
         )
+        return message
 
     def alive(self):
         try:
@@ -656,9 +2228,25 @@ class TlgrmBot:
 
 
 if __name__ == '__main__':
-    lostfilm = Parser()
-    if lostfilm.online() and lostfilm.bot.alive():
-        lostfilm.check_old_episodes()
-        lostfilm.check_new_entries()
-        lostfilm.send_new_episodes()
-        lostfilm.scheduler()
+    argument_parser = ArgumentParser(description='Send new LostFilm entries and planned releases to Telegram.')
+    argument_parser.add_argument('--daemon', action='store_true', help='keep running and poll on the [Daemon] intervals')
+    arguments = argument_parser.parse_args()
+    settings = Conf()
+    state = RunState(settings.state_file)
+    http = HttpClient.from_settings(settings)
+    feed_response = None
+    if not arguments.daemon:
+        feed_response = fetch_quietly(http, settings.rss, conditional=True)
+        if idle_run(settings, state, feed_response):
+            metrics.flush('idle', settings.metrics_file, settings.metrics_textfile)
+            raise SystemExit
+    lostfilm = Parser(settings, http, state, feed_response)
+    if arguments.daemon:
+        Daemon(lostfilm).run()
+    else:
+        if lostfilm.online() and lostfilm.bot.alive():
+            lostfilm.check_old_episodes()
+            lostfilm.check_new_entries()
+            lostfilm.send_new_episodes()
+            lostfilm.scheduler()
+        metrics.flush('cron', settings.metrics_file, settings.metrics_textfile)